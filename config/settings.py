@@ -211,3 +211,19 @@ WORKER_MONTH_COST = float(os.getenv("DJANGO_WORKER_MONTH_COST", 2500))
 PRODUCTIVE_TIME_FRACTION = float(os.getenv("DJANGO_PRODUCTIVE_TIME_FRACTION", 0.7))
 WORKER_MONTH_EXPENSE = WORKER_MONTH_COST / PRODUCTIVE_TIME_FRACTION
 WORKER_HOURLY_EXPENSE = WORKER_MONTH_EXPENSE / MONTH_WORKED_HOURS
+
+FORECAST_UPDATE_WORKERS = int(os.getenv("DJANGO_FORECAST_UPDATE_WORKERS", 2))
+FORECAST_UPDATE_DEBOUNCE = float(os.getenv("DJANGO_FORECAST_UPDATE_DEBOUNCE", 0.3))
+FORECAST_UPDATE_STATS_INTERVAL = int(
+    os.getenv("DJANGO_FORECAST_UPDATE_STATS_INTERVAL", 60)
+)
+PRESENCE_TTL = int(os.getenv("DJANGO_PRESENCE_TTL", 60))
+PRESENCE_HEARTBEAT = int(os.getenv("DJANGO_PRESENCE_HEARTBEAT", 20))
+FEED_LENGTH = int(os.getenv("DJANGO_FEED_LENGTH", 1000))
+FEED_TTL = int(os.getenv("DJANGO_FEED_TTL", PRESENCE_TTL * 10))
+
+IMPORT_JOBS_POLL = float(os.getenv("DJANGO_IMPORT_JOBS_POLL", 1))
+IMPORT_JOBS_TIMEOUT = int(os.getenv("DJANGO_IMPORT_JOBS_TIMEOUT", 900))
+CHECK_BACKUPS_KEPT = int(os.getenv("DJANGO_CHECK_BACKUPS_KEPT", 10))
+
+LIQUIDITY_PAGE_SIZE = int(os.getenv("DJANGO_LIQUIDITY_PAGE_SIZE", 100))
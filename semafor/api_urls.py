@@ -8,4 +8,14 @@ urlpatterns = [
         views.api_update_worker_assessment,
         name="api_update_worker_assessment",
     ),
+    path(
+        "assessment/worker/<str:token>/sync/",
+        views.api_sync_worker_checks,
+        name="api_sync_worker_checks",
+    ),
+    path(
+        "assessment/worker/<str:token>/jobs/<uuid:pk>/",
+        views.api_import_job,
+        name="api_import_job",
+    ),
 ]
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SemaforConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'semafor'
+
+    def ready(self):
+        import semafor.signals  # noqa
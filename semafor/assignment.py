@@ -0,0 +1,176 @@
+import re
+
+from django.db import transaction
+from django.db.models import Q
+
+from semafor.models import AssignmentRule
+from semafor.models import Transaction
+from semafor.models import TransactionProjectAssignment
+from semafor.models import TransactionWorkerAssignment
+from semafor.models import month_ordinal
+from semafor.rollup import deferred_refresh
+from semafor.rollup import schedule_refresh
+
+# Transactions without projects or without workers are assigned by the first
+# AssignmentRule, in creation order, that matches their concept. The substring
+# rules are compiled into an Aho-Corasick automaton that finds all of them in a
+# single pass over the concept, whatever their number; the regular expressions
+# are then searched one by one, only those of rules before the first substring
+# rule found.
+
+FLAGS = re.IGNORECASE | re.DOTALL
+
+
+class SubstringMatcher:
+    def __init__(self, patterns):
+        # trie of the lowercase patterns; each state keeps the first pattern
+        # ending there or at any of its suffix states
+        self.goto = [{}]
+        self.first = [None]
+        for i, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern.lower():
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.first.append(None)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            if self.first[state] is None:
+                self.first[state] = i
+
+        # suffix links, in breadth first order
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.first[next_state] = min_index(
+                    self.first[next_state], self.first[self.fail[next_state]]
+                )
+                queue.append(next_state)
+
+    # index of the first pattern found in the text, or None
+    def __call__(self, text):
+        first = self.first[0]
+        state = 0
+        for char in text.lower():
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            first = min_index(first, self.first[state])
+        return first
+
+
+def min_index(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class RuleMatcher:
+    def __init__(self, rules):
+        self.rules = rules
+        substrings = [(i, rule) for i, rule in enumerate(rules) if not rule.regex]
+        self.substring_rules = [i for i, _ in substrings]
+        self.substrings = SubstringMatcher([rule.pattern for _, rule in substrings])
+        self.regexes = []
+        for i, rule in enumerate(rules):
+            if rule.regex:
+                try:
+                    self.regexes.append((i, re.compile(rule.pattern, FLAGS)))
+                except re.error:
+                    pass
+
+    def __call__(self, concept):
+        first = self.substrings(concept)
+        if first is not None:
+            first = self.substring_rules[first]
+        for i, regex in self.regexes:
+            if first is not None and i > first:
+                break
+            if regex.search(concept):
+                return self.rules[i]
+        return None if first is None else self.rules[first]
+
+
+# List of (transaction, project rule, worker rule) of the transactions with a
+# rule for their missing project or worker
+def match_transactions():
+    rules = list(
+        AssignmentRule.objects.select_related("project", "worker").order_by("pk")
+    )
+    project_rule = RuleMatcher([rule for rule in rules if rule.project_id])
+    worker_rule = RuleMatcher([rule for rule in rules if rule.worker_id])
+
+    unassigned = (
+        Transaction.objects.with_assignment()
+        .filter(Q(has_project=False) | Q(has_worker=False))
+        .only("id", "date", "concept", "amount")
+    )
+
+    matches = []
+    for t in unassigned.iterator(chunk_size=2000):
+        project = None if t.has_project else project_rule(t.concept)
+        worker = None if t.has_worker else worker_rule(t.concept)
+        if project or worker:
+            matches.append((t, project, worker))
+    return matches
+
+
+# Bulk creates the assignments, which skips the signals refreshing the months
+# of the projects
+def bulk_assign(projects=(), workers=()):
+    with deferred_refresh(), transaction.atomic():
+        TransactionProjectAssignment.objects.bulk_create(projects, batch_size=1000)
+        TransactionWorkerAssignment.objects.bulk_create(workers, batch_size=1000)
+        for assignment in projects:
+            date = assignment.transaction.date
+            schedule_refresh(
+                assignment.project_id, [month_ordinal(date.year, date.month)]
+            )
+
+
+# Assigns the transactions to the project and the worker, if given and not
+# already assigned to them
+def assign_transactions(transactions, project=None, worker=None):
+    projects = []
+    workers = []
+    with transaction.atomic():
+        for t in transactions:
+            if project and project not in t.projects.all():
+                projects.append(
+                    TransactionProjectAssignment(transaction=t, project=project)
+                )
+            if worker and worker not in t.workers.all():
+                workers.append(
+                    TransactionWorkerAssignment(transaction=t, worker=worker)
+                )
+        bulk_assign(projects, workers)
+    return len(projects) + len(workers)
+
+
+# Assigns the matched transactions, or only returns the matches on a dry run
+def auto_assign_transactions(dry_run=False):
+    if dry_run:
+        return match_transactions()
+
+    with transaction.atomic():
+        matches = match_transactions()
+        bulk_assign(
+            [
+                TransactionProjectAssignment(transaction=t, project_id=rule.project_id)
+                for t, rule, _ in matches
+                if rule
+            ],
+            [
+                TransactionWorkerAssignment(transaction=t, worker_id=rule.worker_id)
+                for t, _, rule in matches
+                if rule
+            ],
+        )
+    return matches
@@ -1,34 +1,173 @@
-import datetime as dt
+import decimal
+import zipfile
+import itertools
+
+import openpyxl
 import pandas as pd
 
+from django.db import transaction
+from django.db.models import Max
+from django.utils.translation import gettext as _
+
 from semafor.models import Transaction
 
 
+# Bank statements exported from RuralVia: a few title rows, the header and a
+# transaction on each row. The columns are found once per file by their label,
+# which depends on the language of the export, and xlsx files are streamed from
+# a read-only workbook in chunks of rows converted by pandas, so that long
+# exports are never loaded whole.
 class RuralVia:
+    SKIP_ROWS = 3
+    CHUNK_SIZE = 5000
+    LABELS = {
+        "id": ["Núm. Apunt", "Nro. Apunte"],
+        "date": ["Fecha valor", "Data valor"],
+        "concept": ["Concepto", "Tipo Movimiento"],
+        "amount": ["Importe", "Import"],
+        "balance": ["Saldo"],
+    }
+
     def __init__(self, filename):
-        self.df = pd.read_excel(filename, skiprows=3)
+        self.filename = filename
 
-    def get_field(self, row, labels):
-        for label in labels:
-            try:
-                return row[label]
-            except Exception:
-                pass
+    # position of the column of each field
+    def get_columns(self, header):
+        columns = {}
+        for field, labels in self.LABELS.items():
+            found = [header.index(label) for label in labels if label in header]
+            if not found:
+                raise Exception(f"Could not find labels {labels}; got {header}")
+            columns[field] = found[0]
+        return columns
 
-        raise Exception(f"Could not find labels {labels}; got {row.index.to_list()}")
+    def get_chunks(self):
+        if not zipfile.is_zipfile(self.filename):
+            df = pd.read_excel(self.filename, skiprows=self.SKIP_ROWS)
+            columns = self.get_columns(df.columns.to_list())
+            df = df.iloc[:, list(columns.values())]
+            df.columns = list(columns)
+            yield df
+            return
 
-    def get_transactions(self):
-        for _, row in self.df.iterrows():
-            date_str = self.get_field(row, ["Fecha valor", "Data valor"])
+        # from a file object, as openpyxl rejects paths without an xlsx extension
+        # such as the files of the import jobs
+        with open(self.filename, "rb") as fp:
+            workbook = openpyxl.load_workbook(fp, read_only=True, data_only=True)
             try:
-                date = date_str.date()
-            except Exception:
-                date = dt.datetime.strptime(date_str, "%d/%m/%Y").date()
+                rows = workbook.active.iter_rows(
+                    min_row=self.SKIP_ROWS + 1, values_only=True
+                )
+                columns = self.get_columns(list(next(rows)))
+                while chunk := list(itertools.islice(rows, self.CHUNK_SIZE)):
+                    yield pd.DataFrame(
+                        [[row[i] for i in columns.values()] for row in chunk],
+                        columns=list(columns),
+                    )
+            finally:
+                workbook.close()
+
+    # (id, date, concept, amount, balance) of each transaction; dates are either
+    # cells formatted as dates or dd/mm/yyyy text
+    def get_rows(self):
+        for df in self.get_chunks():
+            df = df.dropna(subset=["id"])
+            yield from zip(
+                df["id"].astype(int),
+                pd.to_datetime(df["date"], format="%d/%m/%Y").dt.date,
+                df["concept"].fillna("").astype(str),
+                pd.to_numeric(df["amount"]),
+                pd.to_numeric(df["balance"]),
+            )
 
+    def get_transactions(self):
+        for id, date, concept, amount, balance in self.get_rows():
             yield Transaction(
-                id=self.get_field(row, ["Núm. Apunt", "Nro. Apunte"]),
-                date=date,
-                concept=self.get_field(row, ["Concepto", "Tipo Movimiento"]),
-                amount=self.get_field(row, ["Importe", "Import"]),
-                balance=self.get_field(row, ["Saldo"]),
+                id=id, date=date, concept=concept, amount=amount, balance=balance
+            )
+
+
+def from_cents(value):
+    return decimal.Decimal(int(value)).scaleb(-2)
+
+
+# Rows whose balance is not the balance of the previous one plus their amount,
+# the balance before the first row being previous_balance if not None
+def balance_breaks(df, previous_balance):
+    previous = df["balance"].shift(1)
+    previous.iloc[0] = previous_balance
+    df = df.assign(previous=previous)
+    return df[previous.notna() & (df["balance"] != previous + df["amount"])]
+
+
+# Only the transactions of the file that are not stored yet are written, and
+# only if the file is consistent: the stored transactions it repeats must be
+# equal and the balance of each transaction must follow from the previous one,
+# starting from the stored transaction before the file, so that gaps and
+# overlaps are reported instead of written. Returns the counts of inserted and
+# already stored transactions, or the errors found.
+def import_transactions(filename, progress=None):
+    df = pd.DataFrame(
+        RuralVia(filename).get_rows(),
+        columns=["id", "date", "concept", "amount", "balance"],
+    )
+    if progress:
+        progress(50)
+    if df.empty:
+        return {"inserted": 0, "unchanged": 0}
+
+    df = df.drop_duplicates("id", keep="last").sort_values("id")
+    # in cents, so that balances add up exactly
+    for column in ["amount", "balance"]:
+        df[column] = (df[column] * 100).round().astype("int64")
+
+    last_id = Transaction.objects.aggregate(last=Max("id"))["last"] or 0
+    stored = Transaction.objects.filter(
+        pk__in=[id for id in df["id"] if id <= last_id]
+    ).values_list("id", "date", "concept", "amount", "balance")
+    existing = {id: tuple(values) for id, *values in stored}
+    previous = (
+        Transaction.objects.filter(id__lt=df["id"].iloc[0])
+        .order_by("-id")
+        .values_list("balance", flat=True)
+        .first()
+    )
+
+    errors = []
+    breaks = balance_breaks(df, None if previous is None else int(previous * 100))
+    for row in breaks.itertuples():
+        errors.append(
+            _(
+                "Moviment %(id)s (%(date)s): el saldo %(balance)s no és el saldo "
+                "anterior %(previous)s més l'import %(amount)s"
             )
+            % {
+                "id": row.id,
+                "date": row.date,
+                "balance": from_cents(row.balance),
+                "previous": from_cents(row.previous),
+                "amount": from_cents(row.amount),
+            }
+        )
+
+    new = []
+    for id, date, concept, amount, balance in df.itertuples(index=False):
+        amount, balance = from_cents(amount), from_cents(balance)
+        if id not in existing:
+            new.append(
+                Transaction(
+                    id=id, date=date, concept=concept, amount=amount, balance=balance
+                )
+            )
+        elif existing[id] != (date, concept, amount, balance):
+            errors.append(
+                _("Moviment %(id)s: no coincideix amb el moviment desat") % {"id": id}
+            )
+
+    if errors:
+        return {"errors": errors}
+
+    with transaction.atomic():
+        Transaction.objects.bulk_create(new, batch_size=1000)
+
+    return {"inserted": len(new), "unchanged": len(existing)}
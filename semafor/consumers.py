@@ -1,44 +1,112 @@
-import redis
+import json
+import asyncio
+import redis.asyncio
 
 from django.conf import settings
-from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-r = redis.Redis(
+from semafor.presence import join_presence
+from semafor.presence import leave_presence
+from semafor.presence import live_groups
+from semafor.feed import read_since
+from semafor.feed import seq_marker
+from semafor.utils import forecast_updates
+from semafor.utils import parse_month
+from semafor.utils import render_forecast_fragment
+from semafor.utils import window_group
+
+# shared by the consumers of this process, which run in the same event loop
+r = redis.asyncio.Redis(
     host=settings.REDIS_HOST,
     port=settings.REDIS_PORT,
     decode_responses=True,
 )
-r.flushall()
 
 
 class ForecastConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        self.subscription_group_name = None
+        self.heartbeat_task = None
         self.worker_id = self.scope["url_route"]["kwargs"].get("worker_id")
         self.project_id = self.scope["url_route"]["kwargs"].get("project_id")
 
         if self.worker_id:
-            self.subscription_group_name = f"forecast_worker_{self.worker_id}"
+            self.base_group_name = f"forecast_worker_{self.worker_id}"
         elif self.project_id:
-            self.subscription_group_name = f"forecast_project_{self.project_id}"
+            self.base_group_name = f"forecast_project_{self.project_id}"
         else:
-            self.subscription_group_name = "forecast_all"
-
-        await self.channel_layer.group_add(
-            self.subscription_group_name, self.channel_name
-        )
+            self.base_group_name = "forecast_all"
 
-        await sync_to_async(r.incr)(self.subscription_group_name)
+        await self.subscribe(self.base_group_name)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
         await self.accept()
 
     async def disconnect(self, close_code):
-        await sync_to_async(r.decr)(self.subscription_group_name)
-        await self.channel_layer.group_discard(
-            self.subscription_group_name, self.channel_name
-        )
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        await self.unsubscribe()
+
+    async def subscribe(self, group):
+        await self.channel_layer.group_add(group, self.channel_name)
+        self.subscription_group_name = group
+
+        # nobody was subscribed, so the group may have changed without updates
+        self.stale = not await live_groups(r, [group])
+        await join_presence(r, group, self.channel_name, self.base_group_name)
+
+    async def unsubscribe(self):
+        group = self.subscription_group_name
+        if group is None:
+            return
+        self.subscription_group_name = None
+        await leave_presence(r, group, self.channel_name)
+        await self.channel_layer.group_discard(group, self.channel_name)
 
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT)
+            if self.subscription_group_name:
+                await join_presence(
+                    r,
+                    self.subscription_group_name,
+                    self.channel_name,
+                    self.base_group_name,
+                )
+
+    # {"window": {"start": "2026-10", "end": "2027-06"}, "resume": 41}: the
+    # window of months shown by the page, if not the default one, and the
+    # sequence number of its last update
     async def receive(self, text_data):
-        pass
+        try:
+            message = json.loads(text_data)
+            seq = int(message["resume"])
+            window = message.get("window") or {}
+            group = window_group(
+                self.base_group_name,
+                parse_month(window.get("start")),
+                parse_month(window.get("end")),
+            )
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+
+        if group != self.subscription_group_name:
+            await self.unsubscribe()
+            await self.subscribe(group)
+        await self.resume(seq)
+
+    async def resume(self, seq):
+        group = self.subscription_group_name
+        last, missed = await read_since(r, group, seq)
+        if missed is None:
+            content = await database_sync_to_async(render_forecast_fragment)(group)
+            await self.send(content + seq_marker(last))
+        elif missed:
+            await self.send("".join(missed) + seq_marker(last))
+
+        if self.stale:
+            self.stale = False
+            await forecast_updates.notify([self.base_group_name])
 
     async def forecast_update(self, event):
         await self.send(event["content"])
@@ -0,0 +1,119 @@
+import datetime as dt
+
+import numpy as np
+
+from django.db.models import Sum
+
+from semafor.models import WorkForecast
+from semafor.models import WorkAssessment
+from semafor.models import month_ordinal
+
+
+def filter_time_span(qs, time_span):
+    if len(time_span) == 0:
+        return qs.none()
+    return qs.filter(
+        ym__gte=month_ordinal(*time_span[0]),
+        ym__lte=month_ordinal(*time_span[-1]),
+    )
+
+
+# Dense project x worker x month array of a work table, loaded with a single
+# grouped query restricted to the months of the time span. Every total the
+# grids need is a reduction over some of its axes.
+class WorkCube:
+    model = None
+    field = None
+
+    def __init__(self, projects, workers, time_span):
+        self.projects = list(projects)
+        self.workers = list(workers)
+        self.time_span = list(time_span)
+        self.project_index = {p.pk: i for i, p in enumerate(self.projects)}
+        self.worker_index = {w.pk: i for i, w in enumerate(self.workers)}
+        shape = (len(self.projects), len(self.workers), len(self.time_span))
+        self.values = np.zeros(shape, dtype=np.int64)
+        self.present = np.zeros(shape, dtype=bool)
+        self.confirmed = np.array([p.confirmed for p in self.projects], dtype=bool)
+        if self.values.size > 0:
+            self.load()
+
+    def load(self):
+        first = month_ordinal(*self.time_span[0])
+        qs = self.model.objects.filter(
+            project__in=self.project_index.keys(),
+            worker__in=self.worker_index.keys(),
+        )
+        rows = (
+            filter_time_span(qs, self.time_span)
+            .values_list("project", "worker", "ym")
+            .annotate(total=Sum(self.field))
+        )
+        for project_id, worker_id, ym, total in rows:
+            i = self.project_index[project_id]
+            j = self.worker_index[worker_id]
+            self.values[i, j, ym - first] += self.to_int(total)
+            self.present[i, j, ym - first] = True
+
+    def to_int(self, value):
+        return value
+
+    def to_value(self, value):
+        return int(value)
+
+    def select(self, project=None, worker=None, confirmed=False):
+        values, present, rows = self.values, self.present, self.confirmed
+        if project:
+            i = self.project_index.get(project.pk)
+            if i is None:
+                return values[:0], present[:0]
+            values, present = values[i : i + 1], present[i : i + 1]
+            rows = rows[i : i + 1]
+        if confirmed:
+            values, present = values[rows], present[rows]
+        if worker:
+            j = self.worker_index.get(worker.pk)
+            if j is None:
+                return values[:, :0], present[:, :0]
+            values, present = values[:, j : j + 1], present[:, j : j + 1]
+        return values, present
+
+    def totals(self, project=None, worker=None, confirmed=False):
+        values, present = self.select(project, worker, confirmed)
+        sums = values.sum(axis=(0, 1))
+        mask = present.any(axis=(0, 1))
+        return {self.time_span[k]: self.to_value(sums[k]) for k in np.flatnonzero(mask)}
+
+    def explanations(self, project, worker=None):
+        values, present = self.select(project, worker)
+        explanations = {}
+        for k in np.flatnonzero(present.any(axis=(0, 1))):
+            workers = [worker] if worker else self.workers
+            explanations[self.time_span[k]] = ", ".join(
+                f"{w.name} ({self.to_value(values[0, j, k])})"
+                for j, w in enumerate(workers)
+                if present[0, j, k]
+            )
+        return explanations
+
+    def content_classes(self, project=None, worker=None):
+        values, _ = self.select(project, worker)
+        if values.sum() > 0:
+            return "full"
+        return "empty"
+
+
+class ForecastCube(WorkCube):
+    model = WorkForecast
+    field = "forecast"
+
+
+class AssessmentCube(WorkCube):
+    model = WorkAssessment
+    field = "assessment"
+
+    def to_int(self, value):
+        return value // dt.timedelta(microseconds=1)
+
+    def to_value(self, value):
+        return dt.timedelta(microseconds=int(value))
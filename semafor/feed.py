@@ -0,0 +1,60 @@
+from django.conf import settings
+
+# Every update sent to a subscription group is also appended to a Redis stream
+# of that group, with consecutive sequence numbers as entry ids, so that a
+# client that lost its websocket can ask for the updates after the last one it
+# got instead of reloading the page. Streams are trimmed to the last
+# FEED_LENGTH updates; clients further behind get the whole fragment. Clients
+# choose the windows of months of their groups, so the keys of a group expire
+# FEED_TTL seconds after its last update or heartbeat of a subscriber.
+
+APPEND = """
+local seq = redis.call("INCR", KEYS[1])
+redis.call("XADD", KEYS[2], "MAXLEN", "~", ARGV[2], seq .. "-0", "content", ARGV[1])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("EXPIRE", KEYS[2], ARGV[3])
+return seq
+"""
+
+
+def seq_key(group):
+    return f"feed_seq_{group}"
+
+
+def feed_key(group):
+    return f"feed_{group}"
+
+
+# swapped out of band with each update, the client sends it back to resume
+def seq_marker(seq):
+    return f'<div id="forecast-feed" data-seq="{seq}" hidden></div>'
+
+
+def current_seq(r, group):
+    return int(r.get(seq_key(group)) or 0)
+
+
+async def append(r, group, content):
+    return await r.eval(
+        APPEND,
+        2,
+        seq_key(group),
+        feed_key(group),
+        content,
+        settings.FEED_LENGTH,
+        settings.FEED_TTL,
+    )
+
+
+# Sequence number of the last update and the updates after seq, or None instead
+# of the updates if some of them were already trimmed
+async def read_since(r, group, seq):
+    entries = await r.xrange(feed_key(group), min=f"{seq + 1}-0")
+    ids = [int(id.split("-")[0]) for id, _ in entries]
+    if ids and ids[0] == seq + 1:
+        return ids[-1], [fields["content"] for _, fields in entries]
+
+    last = int(await r.get(seq_key(group)) or 0)
+    if not ids and last == seq:
+        return seq, []
+    return last, None
@@ -0,0 +1,73 @@
+import hashlib
+
+import lxml.html
+from lxml import etree
+
+
+def digest(markup):
+    return hashlib.blake2b(markup.encode(), digest_size=8).hexdigest()
+
+
+def serialize(element):
+    return lxml.html.tostring(element, encoding="unicode", with_tail=False)
+
+
+# Splits a rendered fragment into its elements with an id (rows, cells, totals)
+# and the skeleton around them. The digest of each element covers only its own
+# markup, with the elements with an id inside it replaced by placeholders, so
+# that a changed cell does not mark the row containing it as changed.
+def parse(content):
+    root = lxml.html.fragment_fromstring(content.strip())
+    elements = [e for e in root.iterdescendants() if e.get("id")]
+    markup = {e.get("id"): serialize(e) for e in elements}
+    parents = {}
+    for e in elements:
+        parent = next((a for a in e.iterancestors() if a.get("id")), root)
+        if parent is not root:
+            parents[e.get("id")] = parent.get("id")
+
+    digests = {}
+    for e in reversed(elements):
+        digests[e.get("id")] = digest(serialize(e))
+        placeholder = etree.Element("slot", id=e.get("id"))
+        placeholder.tail = e.tail
+        e.getparent().replace(e, placeholder)
+
+    snapshot = {
+        "skeleton": digest(serialize(root)),
+        "digests": digests,
+        "unique": len(markup) == len(elements),
+    }
+    return snapshot, markup, parents
+
+
+# Returns the snapshot of the new content and the markup to send to the clients
+# that have the previous one: the changed elements, swapped out of band by id,
+# or the whole content if the structure changed
+def diff(previous, content):
+    snapshot, markup, parents = parse(content)
+    if (
+        previous is None
+        or not snapshot["unique"]
+        or previous["skeleton"] != snapshot["skeleton"]
+    ):
+        return snapshot, content
+
+    changed = {
+        id
+        for id, value in snapshot["digests"].items()
+        if previous["digests"].get(id) != value
+    }
+
+    def ancestor_changed(id):
+        while id in parents:
+            id = parents[id]
+            if id in changed:
+                return True
+        return False
+
+    return snapshot, "".join(
+        value
+        for id, value in markup.items()
+        if id in changed and not ancestor_changed(id)
+    )
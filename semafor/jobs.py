@@ -0,0 +1,221 @@
+import gzip
+import contextlib
+import hashlib
+import threading
+import traceback
+import datetime as dt
+
+from pathlib import Path
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from semafor.models import ImportJob
+from semafor.banking import import_transactions
+from semafor.assignment import auto_assign_transactions
+from semafor.time_control import update_worker_assessments_aux
+
+# Uploads are not imported by the request that sends them: the file is saved
+# and an ImportJob queued in the database, which the run_import_jobs command
+# claims and runs, keeping its progress and result up to date for the status
+# views to poll.
+
+JOBS_PATH = Path("import_jobs")
+BACKUPS_PATH = Path("db_backups")
+
+
+def job_path(job):
+    return JOBS_PATH / str(job.uuid)
+
+
+def backups_path(worker):
+    return BACKUPS_PATH / str(worker.uuid)
+
+
+# The upload is streamed to the job file and hashed on the way; the check files
+# of the workers are also kept gzipped under their hash. A check file equal to
+# the last one imported without problems is not imported again.
+def enqueue_import(kind, uploaded_file, worker=None):
+    job = ImportJob(kind=kind, worker=worker)
+    JOBS_PATH.mkdir(exist_ok=True)
+    if kind == "WORKER_ASSESSMENTS":
+        backups_path(worker).mkdir(parents=True, exist_ok=True)
+        backup = backups_path(worker) / f"{job.uuid}.tmp"
+    else:
+        backup = None
+
+    digest = hashlib.sha256()
+    with open(job_path(job), "wb") as fp, optional_gzip(backup) as gz:
+        for chunk in uploaded_file.chunks():
+            digest.update(chunk)
+            fp.write(chunk)
+            if gz:
+                gz.write(chunk)
+    job.content_hash = digest.hexdigest()
+
+    if backup:
+        backup.replace(backups_path(worker) / f"{job.content_hash}.db.gz")
+        prune_backups(worker)
+        if job.content_hash == last_imported_hash(worker):
+            job_path(job).unlink()
+            job.status = "DONE"
+            job.progress = 100
+            job.result = {"unchanged": True}
+
+    job.save()
+    return job
+
+
+def optional_gzip(path):
+    if path is None:
+        return contextlib.nullcontext()
+    return gzip.open(path, "wb")
+
+
+def last_imported_hash(worker):
+    job = (
+        ImportJob.objects.filter(worker=worker, kind="WORKER_ASSESSMENTS")
+        .exclude(status__in=["PENDING", "RUNNING"])
+        .order_by("-created")
+        .first()
+    )
+    return job.content_hash if job and job.ok() else None
+
+
+# keeps the CHECK_BACKUPS_KEPT most recently uploaded backups of the worker
+def prune_backups(worker):
+    backups = sorted(
+        backups_path(worker).glob("*.db.gz"),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+    for path in backups[settings.CHECK_BACKUPS_KEPT :]:
+        path.unlink(missing_ok=True)
+
+
+# Oldest pending job, marked as running; the update only matches if no other
+# process claimed it first. The process running a job renews its lease on the
+# job, its updated time, every third of IMPORT_JOBS_TIMEOUT, so running jobs not
+# updated in IMPORT_JOBS_TIMEOUT seconds were left by a process that died, and
+# are queued again.
+def claim_job():
+    now = timezone.now()
+    ImportJob.objects.filter(
+        status="RUNNING",
+        updated__lt=now - dt.timedelta(seconds=settings.IMPORT_JOBS_TIMEOUT),
+    ).update(status="PENDING", progress=0, updated=now)
+
+    pending = ImportJob.objects.filter(status="PENDING").order_by("created")
+    for pk in pending.values_list("pk", flat=True)[:10]:
+        claimed = ImportJob.objects.filter(pk=pk, status="PENDING").update(
+            status="RUNNING", updated=timezone.now()
+        )
+        if claimed:
+            return ImportJob.objects.get(pk=pk)
+    return None
+
+
+# Every write of the running job also renews the lease, and only matches while
+# the job is still running with the updated time of the last renewal, so a run
+# whose job was queued again stops writing it
+class JobLease:
+    def __init__(self, job):
+        self.job = job
+        self.owned = True
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def renew(self, **fields):
+        with self.lock:
+            if self.owned:
+                now = timezone.now()
+                self.owned = bool(
+                    ImportJob.objects.filter(
+                        pk=self.job.pk, status="RUNNING", updated=self.job.updated
+                    ).update(updated=now, **fields)
+                )
+                if self.owned:
+                    self.job.updated = now
+            return self.owned
+
+    def keep_alive(self):
+        try:
+            while not self.stopped.wait(settings.IMPORT_JOBS_TIMEOUT / 3):
+                try:
+                    if not self.renew():
+                        return
+                except DatabaseError:
+                    # e.g. SQLite locked by the import; retried on the next beat
+                    traceback.print_exc()
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.keep_alive, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_job(job):
+    with JobLease(job) as lease:
+
+        def progress(percentage):
+            if percentage != job.progress:
+                job.progress = percentage
+                lease.renew(progress=percentage)
+
+        try:
+            job.result = IMPORTERS[job.kind](job, progress)
+            job.status = "DONE"
+        except Exception:
+            traceback.print_exc()
+            job.result = {}
+            job.status = "FAILED"
+
+    job.progress = 100
+    if lease.renew(status=job.status, result=job.result, progress=job.progress):
+        job_path(job).unlink(missing_ok=True)
+    else:
+        print(f"Import job {job.uuid} was queued again, its result is discarded")
+    return job
+
+
+def import_worker_assessments(job, progress):
+    missing_projects, errors = update_worker_assessments_aux(
+        job.worker, job_path(job), progress
+    )
+    return {"missing_projects": sorted(missing_projects), "errors": errors}
+
+
+# the new transactions are assigned by the assignment rules; the import is
+# already committed, so failing to assign does not fail the job
+def import_liquidity(job, progress):
+    result = import_transactions(job_path(job), progress)
+    if result.get("inserted"):
+        try:
+            result["assigned"] = len(auto_assign_transactions())
+        except Exception as ex:
+            traceback.print_exc()
+            result["assign_error"] = str(ex)
+    return result
+
+
+IMPORTERS = {
+    "WORKER_ASSESSMENTS": import_worker_assessments,
+    "LIQUIDITY": import_liquidity,
+}
+
+
+def job_status(job):
+    return {
+        "status": job.status,
+        "progress": job.progress,
+        "ok": job.ok(),
+        "missing_projects": job.result.get("missing_projects", []),
+        "errors": job.result.get("errors", []),
+    }
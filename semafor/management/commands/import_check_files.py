@@ -0,0 +1,130 @@
+import gzip
+import time
+import uuid
+import shutil
+import tempfile
+
+import django
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from semafor.models import Worker
+from semafor.time_control import ControlHorari
+from semafor.time_control import worker_assessments
+from semafor.time_control import apply_worker_assessments
+from semafor.time_control import add_missing_aliases
+from semafor.rollup import deferred_refresh
+
+
+def is_uuid(name):
+    try:
+        uuid.UUID(name)
+        return True
+    except ValueError:
+        return False
+
+
+# The worker of a check file is the name of the file, <uuid>.db, or of its
+# directory, <uuid>/<hash>.db.gz, where only the newest file is imported
+def find_check_files(paths):
+    files = {}
+    for path in map(Path, paths):
+        candidates = [path] if path.is_file() else sorted(path.iterdir())
+        for candidate in candidates:
+            if candidate.is_dir():
+                backups = list(candidate.glob("*.db.gz"))
+                if backups:
+                    newest = max(backups, key=lambda p: p.stat().st_mtime)
+                    files[candidate.name] = newest
+            elif candidate.name.endswith((".db", ".db.gz")):
+                name = candidate.name.removesuffix(".gz").removesuffix(".db")
+                if not is_uuid(name):
+                    name = candidate.parent.name
+                files[name] = candidate
+    return files
+
+
+def parse_check_file(path):
+    start = time.perf_counter()
+    if path.suffix == ".gz":
+        with gzip.open(path) as src, tempfile.NamedTemporaryFile() as fp:
+            shutil.copyfileobj(src, fp)
+            fp.flush()
+            projects = ControlHorari(fp.name).get_projects_worked_time()
+    else:
+        projects = ControlHorari(path).get_projects_worked_time()
+    return projects, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports the assessments of the workers from Control Horari databases, "
+        "given as files or directories such as db_backups/"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+")
+        parser.add_argument("--processes", type=int, default=None)
+
+    def handle(self, *args, **options):
+        files = find_check_files(options["paths"])
+        if not files:
+            raise CommandError("No check files found")
+
+        workers = Worker.objects.in_bulk(
+            [name for name in files if is_uuid(name)], field_name="uuid"
+        )
+        start = time.perf_counter()
+        imported = 0
+        with (
+            ProcessPoolExecutor(options["processes"], initializer=django.setup) as pool,
+            deferred_refresh(),
+        ):
+            futures = {
+                name: pool.submit(parse_check_file, path)
+                for name, path in files.items()
+                if is_uuid(name) and uuid.UUID(name) in workers
+            }
+            for name, path in files.items():
+                if name not in futures:
+                    self.report(path, error="no worker")
+                    continue
+
+                worker = workers[uuid.UUID(name)]
+                try:
+                    projects, parse_seconds = futures[name].result()
+                except Exception as ex:
+                    self.report(path, worker, error=f"{ex}")
+                    continue
+
+                write_start = time.perf_counter()
+                target, missing_projects = worker_assessments(worker, projects)
+                if missing_projects:
+                    add_missing_aliases(worker, missing_projects)
+                    error = f"missing projects {', '.join(sorted(missing_projects))}"
+                    self.report(path, worker, parse_seconds, error=error)
+                    continue
+
+                with transaction.atomic():
+                    apply_worker_assessments(worker, target)
+                write_seconds = time.perf_counter() - write_start
+                self.report(path, worker, parse_seconds, write_seconds, len(target))
+                imported += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {imported} of {len(files)} files "
+                f"in {time.perf_counter() - start:.2f}s"
+            )
+        )
+
+    def report(self, path, worker=None, parse=0, write=0, rows=0, error=None):
+        line = f"{path} {worker or '-'}: parse {parse:.2f}s, write {write:.2f}s"
+        if error:
+            self.stdout.write(self.style.ERROR(f"{line}, {error}"))
+        else:
+            self.stdout.write(f"{line}, {rows} assessments")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from semafor.rollup import rebuild_project_months
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the ProjectMonth rollup of every project from scratch"
+
+    def handle(self, *args, **options):
+        rows = rebuild_project_months()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(rows)} project months"))
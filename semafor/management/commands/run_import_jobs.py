@@ -0,0 +1,26 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from semafor.jobs import claim_job
+from semafor.jobs import run_job
+
+
+class Command(BaseCommand):
+    help = "Runs the queued import jobs, waiting for new ones unless --once"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true")
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(settings.IMPORT_JOBS_POLL)
+                continue
+
+            run_job(job)
+            self.stdout.write(f"{job}")
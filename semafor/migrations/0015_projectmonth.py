@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:11
+
+import datetime
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("semafor", "0014_remove_worker_app_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProjectMonth",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("year", models.IntegerField()),
+                ("month", models.IntegerField()),
+                ("forecast", models.IntegerField(default=0)),
+                ("assessment", models.DurationField(default=datetime.timedelta(0))),
+                (
+                    "income",
+                    models.DecimalField(decimal_places=2, max_digits=12, null=True),
+                ),
+                (
+                    "other_expenses",
+                    models.DecimalField(decimal_places=2, max_digits=12, null=True),
+                ),
+                (
+                    "work_expenses",
+                    models.DecimalField(decimal_places=2, max_digits=12, null=True),
+                ),
+                (
+                    "balance",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=12),
+                ),
+                ("updated", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "project",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="months",
+                        to="semafor.project",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["year", "month"],
+                "unique_together": {("project", "year", "month")},
+            },
+        ),
+    ]
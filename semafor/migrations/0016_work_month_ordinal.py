@@ -0,0 +1,115 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:19
+
+import django.db.models.expressions
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("semafor", "0015_projectmonth"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="workassessment",
+            name="ym",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.expressions.CombinedExpression(
+                    django.db.models.expressions.CombinedExpression(
+                        django.db.models.expressions.CombinedExpression(
+                            models.F("year"), "*", models.Value(12)
+                        ),
+                        "+",
+                        models.F("month"),
+                    ),
+                    "-",
+                    models.Value(1),
+                ),
+                output_field=models.IntegerField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="workermonthdedication",
+            name="ym",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.expressions.CombinedExpression(
+                    django.db.models.expressions.CombinedExpression(
+                        django.db.models.expressions.CombinedExpression(
+                            models.F("year"), "*", models.Value(12)
+                        ),
+                        "+",
+                        models.F("month"),
+                    ),
+                    "-",
+                    models.Value(1),
+                ),
+                output_field=models.IntegerField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="workforecast",
+            name="ym",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.expressions.CombinedExpression(
+                    django.db.models.expressions.CombinedExpression(
+                        django.db.models.expressions.CombinedExpression(
+                            models.F("year"), "*", models.Value(12)
+                        ),
+                        "+",
+                        models.F("month"),
+                    ),
+                    "-",
+                    models.Value(1),
+                ),
+                output_field=models.IntegerField(),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="workassessment",
+            index=models.Index(
+                fields=["project", "ym"], name="semafor_wor_project_4463e2_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="workassessment",
+            index=models.Index(
+                fields=["worker", "ym"], name="semafor_wor_worker__eb4881_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="workassessment",
+            index=models.Index(
+                fields=["worker", "project", "ym"],
+                name="semafor_wor_worker__ea4a58_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="workermonthdedication",
+            index=models.Index(
+                fields=["worker", "ym"], name="semafor_wor_worker__2cf80f_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="workforecast",
+            index=models.Index(
+                fields=["project", "ym"], name="semafor_wor_project_673766_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="workforecast",
+            index=models.Index(
+                fields=["worker", "ym"], name="semafor_wor_worker__416459_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="workforecast",
+            index=models.Index(
+                fields=["worker", "project", "ym"],
+                name="semafor_wor_worker__4135e2_idx",
+            ),
+        ),
+    ]
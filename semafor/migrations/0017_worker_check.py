@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("semafor", "0016_work_month_ordinal"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="worker",
+            name="app_cursor",
+            field=models.IntegerField(
+                default=0,
+                editable=False,
+                verbose_name="Darrer registre sincronitzat de la APP",
+            ),
+        ),
+        migrations.CreateModel(
+            name="WorkerCheck",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("app_id", models.IntegerField()),
+                ("timestamp", models.DateTimeField()),
+                ("check_type", models.CharField(max_length=1000, null=True)),
+                ("multiplier", models.IntegerField(default=100)),
+                (
+                    "worker",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="semafor.worker"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["worker", "timestamp"],
+                        name="semafor_wor_worker__4e79b5_idx",
+                    )
+                ],
+                "unique_together": {("worker", "app_id")},
+            },
+        ),
+    ]
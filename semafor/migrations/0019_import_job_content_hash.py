@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("semafor", "0018_import_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importjob",
+            name="content_hash",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("semafor", "0019_import_job_content_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AssignmentRule",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("pattern", models.CharField(max_length=1000, verbose_name="Patró")),
+                (
+                    "regex",
+                    models.BooleanField(
+                        default=False, verbose_name="Expressió regular"
+                    ),
+                ),
+                (
+                    "project",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="semafor.project",
+                        verbose_name="Projecte",
+                    ),
+                ),
+                (
+                    "worker",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="semafor.worker",
+                        verbose_name="Treballadora",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,79 @@
+from django.db import migrations
+
+# Full text index of the concepts of the transactions, used by semafor.search.
+# On SQLite the FTS5 table is kept in sync by triggers, which are lost if a
+# later migration remakes the semafor_transaction table: such a migration has
+# to create them again.
+
+SQL = {
+    "sqlite": [
+        """
+        CREATE VIRTUAL TABLE semafor_transaction_fts USING fts5(
+            concept,
+            content='semafor_transaction',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER semafor_transaction_fts_insert
+        AFTER INSERT ON semafor_transaction BEGIN
+            INSERT INTO semafor_transaction_fts(rowid, concept)
+            VALUES (new.id, new.concept);
+        END
+        """,
+        """
+        CREATE TRIGGER semafor_transaction_fts_delete
+        AFTER DELETE ON semafor_transaction BEGIN
+            INSERT INTO semafor_transaction_fts(semafor_transaction_fts, rowid, concept)
+            VALUES ('delete', old.id, old.concept);
+        END
+        """,
+        """
+        CREATE TRIGGER semafor_transaction_fts_update
+        AFTER UPDATE ON semafor_transaction BEGIN
+            INSERT INTO semafor_transaction_fts(semafor_transaction_fts, rowid, concept)
+            VALUES ('delete', old.id, old.concept);
+            INSERT INTO semafor_transaction_fts(rowid, concept)
+            VALUES (new.id, new.concept);
+        END
+        """,
+        "INSERT INTO semafor_transaction_fts(semafor_transaction_fts) VALUES ('rebuild')",
+    ],
+    "postgresql": [
+        """
+        CREATE INDEX semafor_transaction_concept_search
+        ON semafor_transaction USING gin (to_tsvector('simple', concept))
+        """,
+    ],
+}
+
+REVERSE_SQL = {
+    "sqlite": [
+        "DROP TRIGGER semafor_transaction_fts_insert",
+        "DROP TRIGGER semafor_transaction_fts_delete",
+        "DROP TRIGGER semafor_transaction_fts_update",
+        "DROP TABLE semafor_transaction_fts",
+    ],
+    "postgresql": ["DROP INDEX semafor_transaction_concept_search"],
+}
+
+
+def create_search_index(apps, schema_editor):
+    for sql in SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    for sql in REVERSE_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("semafor", "0021_transaction_date_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,13 +1,15 @@
+import re
 import uuid
-import copy
 import decimal
 import secrets
 import datetime as dt
 
 from django.db import models
+from django.db.models import Exists, F, Max, Min, OuterRef, Subquery, Sum
 from django.conf import settings
 from django.urls import reverse
 from django.utils import timezone
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import AbstractUser
@@ -23,6 +25,39 @@ def months_range(date_start, date_end):
         yield y, m + 1
 
 
+def month_ordinal(year, month):
+    return 12 * year + month - 1
+
+
+# Stored month ordinal of the work tables, indexed together with their foreign
+# keys so that month ranges can be filtered in the database
+def month_ordinal_field():
+    return models.GeneratedField(
+        expression=F("year") * 12 + F("month") - 1,
+        output_field=models.IntegerField(),
+        db_persist=True,
+    )
+
+
+def month_date(ym):
+    year, month = divmod(ym, 12)
+    return dt.date(year, month + 1, 1)
+
+
+def forecast_expense(work):
+    # TODO set this magic value in the Organization configuration; same in
+    # assessment_expense
+    return round(decimal.Decimal(work / 100 * settings.WORKER_MONTH_EXPENSE), 2)
+
+
+def assessment_expense(work):
+    # TODO set this magic value in the Worker, probably computed from its
+    # expenses and some parameter inside the Organization configuration
+    hours = work.total_seconds() / 3600
+    expense = decimal.Decimal(hours * settings.WORKER_HOURLY_EXPENSE)
+    return round(expense, 2)
+
+
 class User(AbstractUser):
     pass
 
@@ -47,6 +82,35 @@ class User(AbstractUser):
 #    unique index [organization, name]
 
 
+MONTH_BOUNDS = [
+    "first_forecast_ym",
+    "last_forecast_ym",
+    "first_assessment_ym",
+    "last_assessment_ym",
+]
+
+
+def month_bound(model, aggregate):
+    return Subquery(
+        model.objects.filter(project=OuterRef("pk"))
+        .values("project")
+        .annotate(bound=aggregate("ym"))
+        .values("bound")
+    )
+
+
+class ProjectQuerySet(models.QuerySet):
+    # First and last months (as year * 12 + month - 1) with forecasts and
+    # assessments of each project, or None if it has none
+    def with_month_bounds(self):
+        return self.annotate(
+            first_forecast_ym=month_bound(WorkForecast, Min),
+            last_forecast_ym=month_bound(WorkForecast, Max),
+            first_assessment_ym=month_bound(WorkAssessment, Min),
+            last_assessment_ym=month_bound(WorkAssessment, Max),
+        )
+
+
 class Project(models.Model):
     uuid = models.UUIDField(
         default=uuid.uuid4,
@@ -61,6 +125,8 @@ class Project(models.Model):
         default=False, verbose_name=_("Confirmat (segur que s'executarà)")
     )
 
+    objects = ProjectQuerySet.as_manager()
+
     class Meta:
         ordering = ["name"]
 
@@ -70,44 +136,6 @@ class Project(models.Model):
     def get_absolute_url(self):
         return reverse("project_forecast", args=[self.uuid])
 
-    def work_forecasts(self, worker=None):
-        m = {}
-        if worker:
-            forecasts = [x for x in self.workforecast_set.all() if x.worker == worker]
-        else:
-            forecasts = self.workforecast_set.all()
-        for wa in forecasts:
-            m.setdefault((wa.year, wa.month), []).append(wa)
-
-        totals, explanations = {}, {}
-        for k, was in m.items():
-            totals[k] = sum(x.forecast for x in was)
-            explanations[k] = ", ".join(
-                [f"{x.worker.name} ({x.forecast})" for x in was]
-            )
-
-        return totals, explanations
-
-    def work_assessments(self, worker=None):
-        m = {}
-        if worker:
-            assessments = [
-                x for x in self.workassessment_set.all() if x.worker == worker
-            ]
-        else:
-            assessments = self.workassessment_set.all()
-        for a in assessments:
-            m.setdefault((a.year, a.month), []).append(a)
-
-        totals, explanations = {}, {}
-        for k, was in m.items():
-            totals[k] = sum((x.assessment for x in was), start=dt.timedelta(0))
-            explanations[k] = ", ".join(
-                [f"{x.worker.name} ({x.assessment})" for x in was]
-            )
-
-        return totals, explanations
-
     def compute_forecasted_work_expenses(self, worker=None):
         return sum(
             v
@@ -123,30 +151,39 @@ class Project(models.Model):
         return max(self.last_forecast_date(), self.last_assessment_date())
 
     def first_forecast_date(self):
-        return self.child_date(0, self.workforecast_set.all())
+        return self.bound_date("first_forecast_ym")
 
     def first_assessment_date(self):
-        return self.child_date(0, self.workassessment_set.all())
+        return self.bound_date("first_assessment_ym")
 
     def last_forecast_date(self):
-        return self.child_date(-1, self.workforecast_set.all())
+        return self.bound_date("last_forecast_ym")
 
     def last_assessment_date(self):
-        return self.child_date(-1, self.workassessment_set.all())
-
-    def child_date(self, index, qs):
-        dates = sorted(qs, key=lambda x: (x.year, x.month))
-        date = timezone.now().date()
-        if len(dates) > 0:
-            d = dates[index]
-            date = dt.date(d.year, d.month, 1)
-        return date
-
-    def months_range(self, dates, start, end, force_start=None, force_end=None):
-        first, last = start, end
-        if len(dates) > 0:
-            first = dates[0]
-            last = dates[-1]
+        return self.bound_date("last_assessment_ym")
+
+    # Uses the annotations of Project.objects.with_month_bounds() when present
+    def month_bounds(self):
+        if not all(hasattr(self, name) for name in MONTH_BOUNDS):
+            bounds = (
+                Project.objects.with_month_bounds()
+                .filter(pk=self.pk)
+                .values(*MONTH_BOUNDS)
+                .get()
+            )
+            for name, value in bounds.items():
+                setattr(self, name, value)
+        return {name: getattr(self, name) for name in MONTH_BOUNDS}
+
+    def bound_date(self, name):
+        ym = self.month_bounds()[name]
+        if ym is None:
+            return timezone.now().date()
+        return month_date(ym)
+
+    def months_range(self, first, last, start, end, force_start=None, force_end=None):
+        first = start if first is None else month_date(first)
+        last = end if last is None else month_date(last)
         date_start = min(start, dt.date(first.year, first.month, 1))
         date_end = max(
             end + dt.timedelta(days=6 * 31), dt.date(last.year, last.month, 1)
@@ -158,51 +195,49 @@ class Project(models.Model):
 
         return list(months_range(date_start, date_end))
 
-    def forecast_months_range(self, start=None, force_start=None):
-        forecasts = sorted(self.workforecast_set.all(), key=lambda x: (x.year, x.month))
+    def forecast_months_range(self, start=None, force_start=None, force_end=None):
+        bounds = self.month_bounds()
         now = timezone.now().date()
         if start is None:
             start = now
-        return self.months_range(forecasts, start, now, force_start=force_start)
+        return self.months_range(
+            bounds["first_forecast_ym"],
+            bounds["last_forecast_ym"],
+            start,
+            now,
+            force_start=force_start,
+            force_end=force_end,
+        )
 
     def assessment_months_range(self, end=None):
-        assessments = sorted(
-            self.workassessment_set.all(),
-            key=lambda x: (x.year, x.month),
-        )
+        bounds = self.month_bounds()
         now = timezone.now().date()
         if end is None:
             end = now + dt.timedelta(days=31)
-        return self.months_range(assessments, now, end, force_end=end)
+        return self.months_range(
+            bounds["first_assessment_ym"],
+            bounds["last_assessment_ym"],
+            now,
+            end,
+            force_end=end,
+        )
 
     def compute_forecasted_work_expenses_by_months(self, worker=None, min_month=None):
+        months = self.forecast_months_range()
+        forecasts = self.workforecast_set.filter(
+            ym__gte=month_ordinal(*months[0]), ym__lte=month_ordinal(*months[-1])
+        )
         if worker:
-            forecasts = [f for f in self.workforecast_set.all() if f.worker == worker]
-        else:
-            forecasts = self.workforecast_set.all()
-
+            forecasts = forecasts.filter(worker=worker)
         if min_month:
-            year, month = min_month
-            forecasts = [
-                f
-                for f in forecasts
-                if f.year > year or (f.year == year and f.month >= month)
-            ]
+            forecasts = forecasts.filter(ym__gte=month_ordinal(*min_month))
 
-        months = self.forecast_months_range()
+        totals = dict(forecasts.values_list("ym").annotate(total=Sum("forecast")))
         return {
-            (year, month): self.extract_work_expenses_from_forecasts(
-                [f for f in forecasts if f.year == year and f.month == month]
-            )
+            (year, month): forecast_expense(totals.get(month_ordinal(year, month), 0))
             for year, month in months
         }
 
-    def extract_work_expenses_from_forecasts(self, forecasts):
-        work = sum(x.forecast for x in forecasts)
-        # TODO set this magic value in the Organization configuration; same in
-        # compute_assessed_work_expenses
-        return round(decimal.Decimal(work / 100 * settings.WORKER_MONTH_EXPENSE), 2)
-
     def compute_assessed_work_expenses(self, worker=None):
         return sum(
             v
@@ -212,64 +247,23 @@ class Project(models.Model):
         )
 
     def compute_assessed_work_expenses_by_months(self, worker=None, max_month=None):
+        months = self.assessment_months_range()
+        assessments = self.workassessment_set.filter(
+            ym__gte=month_ordinal(*months[0]), ym__lte=month_ordinal(*months[-1])
+        )
         if worker:
-            assessments = [
-                a for a in self.workassessment_set.all() if a.worker == worker
-            ]
-        else:
-            assessments = self.workassessment_set.all()
-
+            assessments = assessments.filter(worker=worker)
         if max_month:
-            year, month = max_month
-            assessments = [
-                a
-                for a in assessments
-                if a.year < year or (a.year == year and a.month < month)
-            ]
+            assessments = assessments.filter(ym__lt=month_ordinal(*max_month))
 
-        months = self.assessment_months_range()
+        totals = dict(assessments.values_list("ym").annotate(total=Sum("assessment")))
         return {
-            (year, month): self.extract_work_expenses_from_assessments(
-                [a for a in assessments if a.year == year and a.month == month]
+            (year, month): assessment_expense(
+                totals.get(month_ordinal(year, month), dt.timedelta(0))
             )
             for year, month in months
         }
 
-    def extract_work_expenses_from_assessments(self, assessments):
-        work = sum((x.assessment for x in assessments), start=dt.timedelta(0))
-        # TODO set this magic value in the Worker, probably computed from its
-        # expenses and some parameter inside the Organization configuration
-        hours = work.total_seconds() / 3600
-        expense = decimal.Decimal(hours * settings.WORKER_HOURLY_EXPENSE)
-        return round(expense, 2)
-
-    def forecast_content_classes(self, time_span, worker=None):
-        time_span = set(time_span)
-        if worker:
-            forecasts = (x for x in self.workforecast_set.all() if x.worker == worker)
-        else:
-            forecasts = self.workforecast_set.all()
-
-        if sum([a.forecast for a in forecasts if (a.year, a.month) in time_span]) > 0:
-            return "full"
-        return "empty"
-
-    def assessment_content_classes(self, time_span, worker=None):
-        time_span = set(time_span)
-        if worker:
-            assessments = (
-                x for x in self.workassessment_set.all() if x.worker == worker
-            )
-        else:
-            assessments = self.workassessment_set.all()
-
-        if sum(
-            (a.assessment for a in assessments if (a.year, a.month) in time_span),
-            start=dt.timedelta(0),
-        ) > dt.timedelta(0):
-            return "full"
-        return "empty"
-
     def amount_span(self):
         _, _, income, expenses, _, _ = self.economic_balance()
         income = sum(income[k] for k in income)
@@ -284,48 +278,50 @@ class Project(models.Model):
         except IndexError:
             return 0
 
+    # Reads the precomputed ProjectMonth rollup; prefetch "months" when it is
+    # needed for many projects
     def economic_balance(self):
-        balance, balance_map = 0, {}
-        income, expenses = {}, {}
-        for t in self.transactions.all():
-            ym = t.date.year, t.date.month
-            if t.amount > 0:
-                income.setdefault(ym, decimal.Decimal())
-                income[ym] += t.amount
-            else:
-                expenses.setdefault(ym, decimal.Decimal())
-                expenses[ym] -= t.amount
-
-        other_expenses = copy.deepcopy(expenses)
-        now = timezone.now()
-        present_month = (now.year, now.month)
-        work_expenses = self.compute_assessed_work_expenses_by_months(
-            max_month=present_month
-        )
-        forecasted_work_expenses = self.compute_forecasted_work_expenses_by_months(
-            min_month=present_month
-        )
-        for k, v in forecasted_work_expenses.items():
-            work_expenses.setdefault(k, decimal.Decimal())
-            work_expenses[k] += v
-
-        for k, v in work_expenses.items():
-            expenses.setdefault(k, decimal.Decimal())
-            expenses[k] += v
-
-        date_start = min(income.keys() | expenses.keys())
-        date_start = dt.date(*date_start, 1)
-        date_end = max(income.keys() | expenses.keys())
-        date_end = dt.date(*date_end, 1)
-        months = list(months_range(date_start, date_end))
-        for ym in months:
-            balance += income.get(ym, 0)
-            balance -= expenses.get(ym, 0)
-            balance_map[ym] = balance
+        months, balance_map = [], {}
+        income, expenses, work_expenses, other_expenses = {}, {}, {}, {}
+        for pm in self.months.all():
+            ym = pm.year, pm.month
+            months.append(ym)
+            balance_map[ym] = pm.balance
+            if pm.income is not None:
+                income[ym] = pm.income
+            if pm.other_expenses is not None:
+                other_expenses[ym] = pm.other_expenses
+            if pm.work_expenses is not None:
+                work_expenses[ym] = pm.work_expenses
+            if pm.other_expenses is not None or pm.work_expenses is not None:
+                expenses[ym] = (pm.other_expenses or 0) + (pm.work_expenses or 0)
 
         return months, balance_map, income, expenses, work_expenses, other_expenses
 
 
+class ProjectMonth(models.Model):
+    project = models.ForeignKey(
+        Project, on_delete=models.CASCADE, related_name="months"
+    )
+    year = models.IntegerField()
+    month = models.IntegerField()
+    forecast = models.IntegerField(default=0)
+    assessment = models.DurationField(default=dt.timedelta(0))
+    # null when the month has no values of that kind, as opposed to zero
+    income = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+    other_expenses = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+    work_expenses = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ["project", "year", "month"]
+        ordering = ["year", "month"]
+
+    def __str__(self):
+        return f"{self.project}: {self.year}-{self.month} {self.balance}"
+
+
 class Worker(models.Model):
     uuid = models.UUIDField(
         default=uuid.uuid4,
@@ -338,6 +334,11 @@ class Worker(models.Model):
         verbose_name=_("Token d'autorització per a la APP"),
         unique=True,
     )
+    app_cursor = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name=_("Darrer registre sincronitzat de la APP"),
+    )
 
     class Meta:
         ordering = ["name"]
@@ -350,33 +351,6 @@ class Worker(models.Model):
             self.app_token = secrets.token_urlsafe(50)
         return super().save(*args, **kwargs)
 
-    def forecast_content_classes(self, time_span, project=None):
-        time_span = set(time_span)
-        if project:
-            forecasts = (x for x in self.workforecast_set.all() if x.project == project)
-        else:
-            forecasts = self.workforecast_set.all()
-
-        if sum([a.forecast for a in forecasts if (a.year, a.month) in time_span]) > 0:
-            return "full"
-        return "empty"
-
-    def assessment_content_classes(self, time_span, project=None):
-        time_span = set(time_span)
-        if project:
-            assessments = (
-                x for x in self.workassessment_set.all() if x.project == project
-            )
-        else:
-            assessments = self.workassessment_set.all()
-
-        if sum(
-            (a.assessment for a in assessments if (a.year, a.month) in time_span),
-            start=dt.timedelta(0),
-        ) > dt.timedelta(0):
-            return "full"
-        return "empty"
-
 
 class ProjectAlias(models.Model):
     worker = models.ForeignKey(Worker, on_delete=models.CASCADE)
@@ -402,6 +376,7 @@ class WorkerMonthDedication(models.Model):
     worker = models.ForeignKey(Worker, on_delete=models.CASCADE)
     year = models.IntegerField()
     month = models.IntegerField()
+    ym = month_ordinal_field()
     dedication = models.IntegerField(
         default=100,
         validators=[MinValueValidator(0), MaxValueValidator(100)],
@@ -409,6 +384,7 @@ class WorkerMonthDedication(models.Model):
 
     class Meta:
         unique_together = ["worker", "year", "month"]
+        indexes = [models.Index(fields=["worker", "ym"])]
 
     def __str__(self):
         return f"{self.worker}: {self.year}-{self.month} {self.dedication}%"
@@ -431,6 +407,7 @@ class WorkForecast(models.Model):
     project = models.ForeignKey(Project, on_delete=models.PROTECT)
     year = models.IntegerField()
     month = models.IntegerField()
+    ym = month_ordinal_field()
     forecast = models.IntegerField(
         default=0,
         validators=[MinValueValidator(0), MaxValueValidator(100)],
@@ -438,6 +415,11 @@ class WorkForecast(models.Model):
 
     class Meta:
         unique_together = ["worker", "project", "year", "month"]
+        indexes = [
+            models.Index(fields=["project", "ym"]),
+            models.Index(fields=["worker", "ym"]),
+            models.Index(fields=["worker", "project", "ym"]),
+        ]
 
     def __str__(self):
         return (
@@ -464,15 +446,84 @@ class WorkAssessment(models.Model):
     project = models.ForeignKey(Project, on_delete=models.PROTECT)
     year = models.IntegerField()
     month = models.IntegerField()
+    ym = month_ordinal_field()
     assessment = models.DurationField()
 
     class Meta:
         unique_together = ["worker", "project", "year", "month"]
+        indexes = [
+            models.Index(fields=["project", "ym"]),
+            models.Index(fields=["worker", "ym"]),
+            models.Index(fields=["worker", "project", "ym"]),
+        ]
 
     def __str__(self):
         return f"{self.worker} - {self.project}: {self.year}-{self.month} {self.assessment}"
 
 
+# Checks pushed by the time control APP through the sync API, app_id being the
+# id of the check in the APP database. The timestamps are the wall clock time of
+# the APP, stored as UTC.
+class WorkerCheck(models.Model):
+    worker = models.ForeignKey(Worker, on_delete=models.CASCADE)
+    app_id = models.IntegerField()
+    timestamp = models.DateTimeField()
+    check_type = models.CharField(max_length=MAX_LENGTH, null=True)
+    multiplier = models.IntegerField(default=100)
+
+    class Meta:
+        unique_together = ["worker", "app_id"]
+        indexes = [models.Index(fields=["worker", "timestamp"])]
+
+
+# Uploaded file waiting to be imported, or being imported, by the
+# run_import_jobs command
+class ImportJob(models.Model):
+    KIND_CHOICES = [
+        ("WORKER_ASSESSMENTS", _("Temps treballats")),
+        ("LIQUIDITY", _("Liquiditat")),
+    ]
+    STATUS_CHOICES = [
+        ("PENDING", _("Pendent")),
+        ("RUNNING", _("En curs")),
+        ("DONE", _("Acabada")),
+        ("FAILED", _("Fallida")),
+    ]
+
+    uuid = models.UUIDField(
+        default=uuid.uuid4,
+        editable=False,
+        primary_key=True,
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    worker = models.ForeignKey(Worker, on_delete=models.CASCADE, null=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="PENDING")
+    # percentage
+    progress = models.IntegerField(default=0)
+    # sha256 of the uploaded file
+    content_hash = models.CharField(max_length=64, blank=True)
+    # missing_projects and errors, or counts of transactions, of the import
+    result = models.JSONField(default=dict)
+    created = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created"])]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.created}: {self.get_status_display()}"
+
+    def finished(self):
+        return self.status in ("DONE", "FAILED")
+
+    def ok(self):
+        return (
+            self.status == "DONE"
+            and not self.result.get("missing_projects")
+            and not self.result.get("errors")
+        )
+
+
 class Tag(models.Model):
     uuid = models.UUIDField(
         default=uuid.uuid4,
@@ -482,6 +533,18 @@ class Tag(models.Model):
     name = models.CharField(max_length=MAX_LENGTH)
 
 
+class TransactionQuerySet(models.QuerySet):
+    def with_assignment(self):
+        return self.annotate(
+            has_project=Exists(
+                TransactionProjectAssignment.objects.filter(transaction=OuterRef("pk"))
+            ),
+            has_worker=Exists(
+                TransactionWorkerAssignment.objects.filter(transaction=OuterRef("pk"))
+            ),
+        )
+
+
 class Transaction(models.Model):
     id = models.IntegerField(primary_key=True)
     date = models.DateField()
@@ -501,8 +564,11 @@ class Transaction(models.Model):
         through="TransactionWorkerAssignment",
     )
 
+    objects = TransactionQuerySet.as_manager()
+
     class Meta:
         ordering = ["id"]
+        indexes = [models.Index(fields=["date", "id"])]
 
 
 class ExpectedTransaction(models.Model):
@@ -556,6 +622,44 @@ class TransactionWorkerAssignment(models.Model):
     worker = models.ForeignKey(Worker, on_delete=models.CASCADE)
 
 
+# Assigns the transactions whose concept contains the pattern, or matches it if
+# it is a regular expression, to the project and the worker of the rule
+class AssignmentRule(models.Model):
+    pattern = models.CharField(max_length=MAX_LENGTH, verbose_name=_("Patró"))
+    regex = models.BooleanField(default=False, verbose_name=_("Expressió regular"))
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        verbose_name=_("Projecte"),
+    )
+    worker = models.ForeignKey(
+        Worker,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        verbose_name=_("Treballadora"),
+    )
+
+    def __str__(self):
+        return f"{self.pattern} → {self.project or ''} {self.worker or ''}"
+
+    def clean(self):
+        if self.project_id is None and self.worker_id is None:
+            raise ValidationError(_("Cal indicar un projecte o una treballadora"))
+        if self.regex:
+            try:
+                re.compile(self.pattern)
+            except re.error as ex:
+                raise ValidationError(
+                    {
+                        "pattern": _("Expressió regular incorrecta: %(error)s")
+                        % {"error": ex}
+                    }
+                )
+
+
 class ExpectedTransactionProjectAssignment(models.Model):
     transaction = models.ForeignKey(ExpectedTransaction, on_delete=models.CASCADE)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
@@ -0,0 +1,75 @@
+import time
+
+from django.conf import settings
+
+from semafor.feed import feed_key
+from semafor.feed import seq_key
+
+# Subscribers of each group are kept in a sorted set with one member per
+# websocket connection, scored with the time it expires at. The consumers
+# refresh their entries on a heartbeat, so the connections of a process that
+# died expire on their own, and processes sharing the Redis server never touch
+# the entries of the others.
+#
+# Pages showing their own window of months subscribe to a variant of their base
+# group; the variants with subscribers are registered in a set of the base
+# group, so that an update of the base group reaches all of them.
+
+
+def presence_key(group):
+    return f"presence_{group}"
+
+
+def variants_key(group):
+    return f"variants_{group}"
+
+
+async def join_presence(r, group, channel_name, base=None):
+    key = presence_key(group)
+    now = time.time()
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zadd(key, {channel_name: now + settings.PRESENCE_TTL})
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.expire(key, settings.PRESENCE_TTL)
+        pipe.expire(seq_key(group), settings.FEED_TTL)
+        pipe.expire(feed_key(group), settings.FEED_TTL)
+        if base and base != group:
+            pipe.sadd(variants_key(base), group)
+            pipe.expire(variants_key(base), settings.PRESENCE_TTL)
+        await pipe.execute()
+
+
+async def leave_presence(r, group, channel_name):
+    await r.zrem(presence_key(group), channel_name)
+
+
+async def live_groups(r, groups):
+    now = time.time()
+    async with r.pipeline(transaction=False) as pipe:
+        for group in groups:
+            pipe.zcount(presence_key(group), now, "+inf")
+        counts = await pipe.execute()
+    return [group for group, count in zip(groups, counts) if count > 0]
+
+
+# The groups and variants with subscribers, as (group, variant) pairs; the
+# variants left without subscribers are unregistered
+async def live_variants(r, groups):
+    async with r.pipeline(transaction=False) as pipe:
+        for group in groups:
+            pipe.smembers(variants_key(group))
+        variants = await pipe.execute()
+
+    candidates = [
+        (group, variant)
+        for group, members in zip(groups, variants)
+        for variant in [group, *sorted(members)]
+    ]
+    live = set(await live_groups(r, [variant for _, variant in candidates]))
+    dead = [(g, v) for g, v in candidates if v != g and v not in live]
+    if dead:
+        async with r.pipeline(transaction=False) as pipe:
+            for group, variant in dead:
+                pipe.srem(variants_key(group), variant)
+            await pipe.execute()
+    return [(group, variant) for group, variant in candidates if variant in live]
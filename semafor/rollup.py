@@ -0,0 +1,300 @@
+import decimal
+import threading
+import contextlib
+import datetime as dt
+
+from django.db import transaction
+from django.db.models import Q, Sum, Min, Max
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+
+from semafor.models import Project
+from semafor.models import ProjectMonth
+from semafor.models import WorkForecast
+from semafor.models import WorkAssessment
+from semafor.models import TransactionProjectAssignment
+from semafor.models import month_ordinal
+from semafor.models import forecast_expense
+from semafor.models import assessment_expense
+
+# ProjectMonth keeps, for each project and month of its economic balance, the
+# aggregated forecasts, assessments and transactions together with the derived
+# work expenses and running balance, so that the assessment pages do not have
+# to replay the whole history of every project on each request.
+
+DERIVED_FIELDS = [
+    "forecast",
+    "assessment",
+    "income",
+    "other_expenses",
+    "work_expenses",
+    "balance",
+    "updated",
+]
+
+_pending = threading.local()
+
+
+def transaction_ym(qs):
+    return qs.annotate(
+        ym=ExtractYear("transaction__date") * 12 + ExtractMonth("transaction__date") - 1
+    )
+
+
+def aggregate_months(project_ids, months=None):
+    raw = {}
+
+    def add(rows, *fields):
+        for project_id, ym, *values in rows:
+            cell = raw.setdefault(project_id, {}).setdefault(ym, {})
+            for field, value in zip(fields, values):
+                if value is not None:
+                    cell[field] = value
+
+    forecasts = WorkForecast.objects.filter(project__in=project_ids)
+    assessments = WorkAssessment.objects.filter(project__in=project_ids)
+    transactions = transaction_ym(
+        TransactionProjectAssignment.objects.filter(project__in=project_ids)
+    )
+    if months is not None:
+        forecasts = forecasts.filter(ym__in=months)
+        assessments = assessments.filter(ym__in=months)
+        transactions = transactions.filter(ym__in=months)
+
+    add(
+        forecasts.values_list("project", "ym").annotate(total=Sum("forecast")),
+        "forecast",
+    )
+    add(
+        assessments.values_list("project", "ym").annotate(total=Sum("assessment")),
+        "assessment",
+    )
+    add(
+        transactions.values_list("project", "ym").annotate(
+            income=Sum("transaction__amount", filter=Q(transaction__amount__gt=0)),
+            other_expenses=-Sum(
+                "transaction__amount", filter=Q(transaction__amount__lte=0)
+            ),
+        ),
+        "income",
+        "other_expenses",
+    )
+    return raw
+
+
+def month_bounds(project_ids):
+    bounds = {project_id: {} for project_id in project_ids}
+    projects = Project.objects.filter(pk__in=project_ids).with_month_bounds()
+    for project in projects:
+        if project.first_forecast_ym is not None:
+            bounds[project.pk]["forecasts"] = (
+                project.first_forecast_ym,
+                project.last_forecast_ym,
+            )
+        if project.first_assessment_ym is not None:
+            bounds[project.pk]["assessments"] = project.first_assessment_ym, None
+
+    transactions = transaction_ym(
+        TransactionProjectAssignment.objects.filter(project__in=project_ids)
+    )
+    for project_id, first, last in transactions.values_list("project").annotate(
+        first=Min("ym"), last=Max("ym")
+    ):
+        bounds[project_id]["transactions"] = first, last
+
+    return bounds
+
+
+def ordinal(date):
+    return month_ordinal(date.year, date.month)
+
+
+# Same months as the assessed and forecasted work expenses computed by
+# Project.assessment_months_range and Project.forecast_months_range
+def month_window(bounds, today):
+    present = ordinal(today)
+    a_first, _ = bounds.get("assessments", (present, None))
+    f_first, f_last = bounds.get("forecasts", (present, present))
+    assessed = min(present, a_first), ordinal(today + dt.timedelta(days=31))
+    forecasted = (
+        min(present, f_first),
+        max(ordinal(today + dt.timedelta(days=6 * 31)), f_last),
+    )
+    start, end = min(assessed[0], forecasted[0]), max(assessed[1], forecasted[1])
+    if "transactions" in bounds:
+        t_first, t_last = bounds["transactions"]
+        start, end = min(start, t_first), max(end, t_last)
+    return range(start, end + 1), assessed, forecasted
+
+
+def derive_project_months(project_id, raw, bounds, now):
+    today = now.date()
+    present = ordinal(today)
+    window, assessed, forecasted = month_window(bounds, today)
+    balance, rows = decimal.Decimal(0), []
+    for ym in window:
+        cell = raw.get(ym, {})
+        forecast = cell.get("forecast", 0)
+        assessment = cell.get("assessment", dt.timedelta(0))
+        work_expenses = None
+        if assessed[0] <= ym <= assessed[1]:
+            work_expenses = decimal.Decimal()
+            if ym < present:
+                work_expenses += assessment_expense(assessment)
+        if forecasted[0] <= ym <= forecasted[1]:
+            work_expenses = work_expenses or decimal.Decimal()
+            if ym >= present:
+                work_expenses += forecast_expense(forecast)
+
+        income = cell.get("income")
+        other_expenses = cell.get("other_expenses")
+        balance += income or 0
+        balance -= (other_expenses or 0) + (work_expenses or 0)
+        year, month = divmod(ym, 12)
+        rows.append(
+            ProjectMonth(
+                project_id=project_id,
+                year=year,
+                month=month + 1,
+                forecast=forecast,
+                assessment=assessment,
+                income=income,
+                other_expenses=other_expenses,
+                work_expenses=work_expenses,
+                balance=balance,
+                updated=now,
+            )
+        )
+    return rows
+
+
+# Refreshes of the same project run one at a time: the rows of the locked
+# projects are read and written in the same transaction. Projects are locked in
+# primary key order, so refreshes of several projects can not deadlock.
+def lock_projects(project_ids):
+    list(
+        Project.objects.select_for_update()
+        .filter(pk__in=project_ids)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+@transaction.atomic
+def rebuild_project_months(project_ids=None):
+    if project_ids is None:
+        project_ids = list(Project.objects.values_list("pk", flat=True))
+    lock_projects(project_ids)
+
+    now = timezone.now()
+    raw = aggregate_months(project_ids)
+    bounds = month_bounds(project_ids)
+    rows = [
+        pm
+        for project_id in project_ids
+        for pm in derive_project_months(
+            project_id, raw.get(project_id, {}), bounds[project_id], now
+        )
+    ]
+    ProjectMonth.objects.filter(project__in=project_ids).delete()
+    ProjectMonth.objects.bulk_create(rows, batch_size=1000)
+    return rows
+
+
+def stale_before():
+    return timezone.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+# Re-aggregates only the given months of the project and recomputes the derived
+# columns from the stored ones; falls back to a full rebuild of the project if
+# its rows were computed in a previous month
+@transaction.atomic
+def refresh_project_months(project_id, months):
+    lock_projects([project_id])
+    stored = {
+        month_ordinal(pm.year, pm.month): pm
+        for pm in ProjectMonth.objects.filter(project_id=project_id)
+    }
+    if (
+        months is None
+        or not stored
+        or any(pm.updated < stale_before() for pm in stored.values())
+    ):
+        return rebuild_project_months([project_id])
+
+    now = timezone.now()
+    bounds = month_bounds([project_id])[project_id]
+    window, _, _ = month_window(bounds, now.date())
+    raw = {
+        ym: {
+            "forecast": pm.forecast,
+            "assessment": pm.assessment,
+            "income": pm.income,
+            "other_expenses": pm.other_expenses,
+        }
+        for ym, pm in stored.items()
+    }
+    months = (set(months) | (set(window) - stored.keys())) & set(window)
+    if months:
+        fresh = aggregate_months([project_id], months=months).get(project_id, {})
+        for ym in months:
+            raw[ym] = fresh.get(ym, {})
+
+    created, changed = [], []
+    for pm in derive_project_months(project_id, raw, bounds, now):
+        old = stored.pop(month_ordinal(pm.year, pm.month), None)
+        if old is None:
+            created.append(pm)
+        elif any(
+            getattr(old, f) != getattr(pm, f) for f in DERIVED_FIELDS if f != "updated"
+        ):
+            pm.pk = old.pk
+            changed.append(pm)
+
+    ProjectMonth.objects.filter(pk__in=[pm.pk for pm in stored.values()]).delete()
+    ProjectMonth.objects.bulk_update(changed, DERIVED_FIELDS, batch_size=1000)
+    ProjectMonth.objects.bulk_create(created, batch_size=1000)
+
+
+def update_stale_project_months():
+    stale = set(
+        ProjectMonth.objects.filter(updated__lt=stale_before())
+        .values_list("project", flat=True)
+        .distinct()
+    )
+    stale |= set(
+        Project.objects.filter(months__isnull=True).values_list("pk", flat=True)
+    )
+    if stale:
+        rebuild_project_months(list(stale))
+
+
+# Inside this block refreshes are collected and applied once per project on
+# a normal exit, so that imports touching many rows do not refresh after each
+# one; if the block raises they are discarded along with its changes
+@contextlib.contextmanager
+def deferred_refresh():
+    if getattr(_pending, "months", None) is not None:
+        yield
+        return
+
+    _pending.months = {}
+    try:
+        yield
+        pending = _pending.months
+    finally:
+        _pending.months = None
+    for project_id, months in pending.items():
+        refresh_project_months(project_id, months)
+
+
+# months=None refreshes every month of the project
+def schedule_refresh(project_id, months=None):
+    pending = getattr(_pending, "months", None)
+    if pending is None:
+        return refresh_project_months(project_id, months)
+
+    if months is None or pending.get(project_id, set()) is None:
+        pending[project_id] = None
+    else:
+        pending.setdefault(project_id, set()).update(months)
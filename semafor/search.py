@@ -0,0 +1,35 @@
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+# The concepts of the transactions are indexed for full text search by the
+# migration 0022_transaction_search: an FTS5 table kept in sync by triggers on
+# SQLite, and a GIN index over their tsvector on PostgreSQL. Each word of the
+# search must start a word of the concept.
+
+FTS_TABLE = "semafor_transaction_fts"
+
+
+def search_terms(query):
+    return re.findall(r"\w+", query or "")
+
+
+def matching_ids(terms):
+    if connection.vendor == "postgresql":
+        return RawSQL(
+            "SELECT id FROM semafor_transaction "
+            "WHERE to_tsvector('simple', concept) @@ to_tsquery('simple', %s)",
+            [" & ".join(f"{term}:*" for term in terms)],
+        )
+    return RawSQL(
+        f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+        [" ".join(f'"{term}"*' for term in terms)],
+    )
+
+
+def search_transactions(qs, query):
+    terms = search_terms(query)
+    if not terms:
+        return qs
+    return qs.filter(id__in=matching_ids(terms))
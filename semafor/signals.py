@@ -0,0 +1,101 @@
+from django.dispatch import receiver
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+
+from semafor.models import Project
+from semafor.models import WorkForecast
+from semafor.models import WorkAssessment
+from semafor.models import Transaction
+from semafor.models import TransactionProjectAssignment
+from semafor.models import month_ordinal
+from semafor.rollup import schedule_refresh
+
+
+def date_month(date):
+    return month_ordinal(date.year, date.month)
+
+
+# ProjectMonth rollup
+
+
+@receiver(post_save, sender=Project)
+def create_project_months(sender, instance, created, **kwargs):
+    if created:
+        schedule_refresh(instance.pk)
+
+
+@receiver(post_init, sender=WorkForecast)
+@receiver(post_init, sender=WorkAssessment)
+def remember_work_month(sender, instance, **kwargs):
+    instance._rollup_month = instance.project_id, instance.year, instance.month
+
+
+@receiver(post_save, sender=WorkForecast)
+@receiver(post_delete, sender=WorkForecast)
+@receiver(post_save, sender=WorkAssessment)
+@receiver(post_delete, sender=WorkAssessment)
+def refresh_work_month(sender, instance, **kwargs):
+    project_id, year, month = instance._rollup_month
+    if project_id and (project_id, year, month) != (
+        instance.project_id,
+        instance.year,
+        instance.month,
+    ):
+        schedule_refresh(project_id, [month_ordinal(year, month)])
+    schedule_refresh(
+        instance.project_id, [month_ordinal(instance.year, instance.month)]
+    )
+
+
+# the previous date of an updated transaction is not known, so the months of
+# its projects are all refreshed
+@receiver(post_save, sender=Transaction)
+def refresh_transaction_projects(sender, instance, created, **kwargs):
+    if created:
+        return
+
+    for project_id in instance.projects.values_list("pk", flat=True):
+        schedule_refresh(project_id)
+
+
+@receiver(post_save, sender=TransactionProjectAssignment)
+@receiver(post_delete, sender=TransactionProjectAssignment)
+def refresh_assignment_month(sender, instance, **kwargs):
+    date = (
+        Transaction.objects.filter(pk=instance.transaction_id)
+        .values_list("date", flat=True)
+        .first()
+    )
+    if date is None:
+        schedule_refresh(instance.project_id)
+    else:
+        schedule_refresh(instance.project_id, [date_month(date)])
+
+
+@receiver(m2m_changed, sender=Transaction.projects.through)
+def refresh_assigned_projects(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        if reverse:
+            instance._rollup_cleared = None
+        else:
+            instance._rollup_cleared = set(
+                instance.projects.values_list("pk", flat=True)
+            )
+        return
+
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if action == "post_clear":
+        pk_set = instance._rollup_cleared
+
+    if reverse:
+        if pk_set is None:
+            schedule_refresh(instance.pk)
+        else:
+            dates = Transaction.objects.filter(pk__in=pk_set).values_list(
+                "date", flat=True
+            )
+            schedule_refresh(instance.pk, {date_month(d) for d in dates})
+    else:
+        for project_id in pk_set:
+            schedule_refresh(project_id, [date_month(instance.date)])
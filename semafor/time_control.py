@@ -1,94 +1,101 @@
+import json
 import sqlite3
 import datetime
-import tempfile
 
 from pathlib import Path
 
+from django.db import transaction
+from django.db.models import Min
+
 from semafor.models import Project
 from semafor.models import ProjectAlias
 from semafor.models import MissingProjectAlias
+from semafor.models import Worker
 from semafor.models import WorkAssessment
-from semafor.models import OutOfBoundsException
+from semafor.models import WorkerCheck
+from semafor.models import month_date
+from semafor.models import month_ordinal
+from semafor.rollup import deferred_refresh
+from semafor.rollup import schedule_refresh
 
 
 # This class handles files coming from the following mobile APP:
 # https://play.google.com/store/apps/details?id=org.transversalcoop.control_horari
+#
+# Checks are walked once in timestamp order: each check with a type starts an
+# interval of that type that ends at the next check, and the intervals crossing
+# the end of a month are split between both months. The checks after the last
+# stop (a check without type) are still running and are discarded.
 class ControlHorari:
-    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
     MIX_HOURS_NAME = "Popurri"
     STRUCTURAL_NAME = "Estructural: altres"
 
     def __init__(self, dbfile):
-        self.db = sqlite3.connect(dbfile)
+        # the uploaded file is never written to
+        uri = Path(dbfile).resolve().as_uri() + "?mode=ro&immutable=1"
+        self.db = sqlite3.connect(uri, uri=True)
         self.cur = self.db.cursor()
 
     def get_projects_worked_time(self):
-        self.discard_dangling_checks()
-        self.get_check_types_names()
-
         all_projects = {}
-        # TODO do all months demanded by user or all months in file
-        for year in range(2023, 2026):
-            for i in range(1, 13):
-                projects = self.get_month_projects_worked_time(f"{year}-{i:02}")
-                for k, v in projects.items():
-                    all_projects.setdefault(k, []).append(
-                        {
-                            "year": year,
-                            "month": i,
-                            "worked_time": v,
-                        }
-                    )
+        for (year, month), projects in sorted(self.get_months_worked_time().items()):
+            for k, v in self.distribute_mix_hours(projects).items():
+                all_projects.setdefault(k, []).append(
+                    {
+                        "year": year,
+                        "month": month,
+                        "worked_time": v,
+                    }
+                )
 
         return all_projects
 
-    def discard_dangling_checks(self):
-        sql = "SELECT check_type_id FROM checks ORDER BY timestamp DESC LIMIT 1;"
-        self.cur.execute(sql)
-        row = self.cur.fetchone()
-        while row is not None and len(row) > 0 and row[0] is not None:
-            self.cur.execute("DELETE FROM checks ORDER BY timestamp DESC LIMIT 1;")
-            self.cur.execute(sql)
-            row = self.cur.fetchone()
-
     def get_check_types_names(self):
         self.check_types = {}
         for row in self.cur.execute("SELECT id, name FROM check_types;"):
             id, name = row
-            self.check_types[id] = name
-
-    def get_month_projects_worked_time(self, date_str):
-        sql = """SELECT timestamp, check_type_id, multiplier FROM checks
-                 WHERE timestamp LIKE ? ORDER BY timestamp ASC;"""
-        lst = []
-        try:
-            for row in self.cur.execute(sql, [date_str + "-%"]):
-                lst.append(
-                    (
-                        datetime.datetime.strptime(row[0], self.TIME_FORMAT),
-                        row[1],
-                        row[2],
-                    )
-                )
-        except Exception:
-            sql = """SELECT timestamp, check_type_id FROM checks
-                     WHERE timestamp LIKE ? ORDER BY timestamp ASC;"""
-            for row in self.cur.execute(sql, [date_str + "-%"]):
-                lst.append(
-                    (datetime.datetime.strptime(row[0], self.TIME_FORMAT), row[1], 100)
-                )
+            self.check_types[id] = name.strip()
+
+    # timestamp, check type name (None for stops) and multiplier of each check,
+    # in timestamp order; older versions of the app have no multiplier
+    def get_checks(self):
+        self.get_check_types_names()
+        columns = [row[1] for row in self.cur.execute("PRAGMA table_info(checks);")]
+        multiplier = "multiplier" if "multiplier" in columns else "100"
+        sql = f"""SELECT timestamp, check_type_id, {multiplier} FROM checks
+                  ORDER BY timestamp ASC;"""
+        for timestamp, check_type_id, multiplier in self.cur.execute(sql):
+            yield (
+                datetime.datetime.fromisoformat(timestamp),
+                None if check_type_id is None else self.check_types[check_type_id],
+                multiplier,
+            )
+
+    def get_months_worked_time(self):
+        # intervals since the last stop
+        months, running = {}, []
+        previous = None
+        for timestamp, name, multiplier in self.get_checks():
+            if previous and previous[1] is not None:
+                running.append((previous, timestamp))
+            if name is None:
+                for (start, name_, multiplier_), end in running:
+                    self.add_interval(months, name_, start, end, multiplier_)
+                running = []
+            previous = timestamp, name, multiplier
 
-        projects = {}
-        for i in range(len(lst) - 1):
-            s, e = lst[i], lst[i + 1]
-            if s[1]:
-                k = self.check_types[s[1]].strip()
-                if k in projects.keys():
-                    projects[k] += (e[0] - s[0]) * s[2] / 100
-                else:
-                    projects[k] = (e[0] - s[0]) * s[2] / 100
+        return months
 
-        return self.distribute_mix_hours(projects)
+    def add_interval(self, months, name, start, end, multiplier):
+        while start < end:
+            next_month = datetime.datetime(
+                start.year + start.month // 12, start.month % 12 + 1, 1
+            )
+            split = min(end, next_month)
+            projects = months.setdefault((start.year, start.month), {})
+            worked_time = (split - start) * multiplier / 100
+            projects[name] = projects.get(name, datetime.timedelta()) + worked_time
+            start = split
 
     def distribute_mix_hours(self, projects):
         total, mix_time = datetime.timedelta(), datetime.timedelta()
@@ -112,56 +119,212 @@ class ControlHorari:
         return new_projects
 
 
-def update_worker_assessments(request, worker):
-    with tempfile.NamedTemporaryFile(delete_on_close=False) as fp:
-        fp.write(request.FILES["checks_file"].read())
-        fp.close()
+# Checks of a worker stored by the sync API, walked from the last stop before
+# the first month to recompute so that the intervals running into it count
+class WorkerChecks(ControlHorari):
+    def __init__(self, worker, first_ym):
+        self.worker = worker
+        self.first_ym = first_ym
 
-        path = Path("db_backups")
-        path.mkdir(exist_ok=True)
-        with open(path / (str(worker.uuid) + ".db"), "wb") as backup:
-            backup.write(open(fp.name, "rb").read())
+    def get_checks(self):
+        checks = WorkerCheck.objects.filter(worker=self.worker)
+        date = month_date(self.first_ym)
+        start = datetime.datetime(
+            date.year, date.month, 1, tzinfo=datetime.timezone.utc
+        )
+        last_stop = (
+            checks.filter(check_type=None, timestamp__lte=start)
+            .order_by("timestamp")
+            .values_list("timestamp", flat=True)
+            .last()
+        )
+        if last_stop is not None:
+            checks = checks.filter(timestamp__gte=last_stop)
 
-        return update_worker_assessments_aux(worker, fp.name)
+        rows = checks.order_by("timestamp").values_list(
+            "timestamp", "check_type", "multiplier"
+        )
+        for timestamp, check_type, multiplier in rows.iterator():
+            yield timestamp.replace(tzinfo=None), check_type, multiplier
 
+    def get_months_worked_time(self):
+        return {
+            (year, month): projects
+            for (year, month), projects in super().get_months_worked_time().items()
+            if month_ordinal(year, month) >= self.first_ym
+        }
 
-def update_worker_assessments_aux(worker, dbfile):
-    WorkAssessment.objects.filter(worker=worker).delete()
+
+# progress is called with the percentage done
+def update_worker_assessments_aux(worker, dbfile, progress=None):
     projects = ControlHorari(dbfile).get_projects_worked_time()
-    db_projects, missing_projects = {}, set()
-    for k in projects:
-        try:
-            project = Project.objects.get(name=k)
-            db_projects[k] = project
-        except Project.DoesNotExist:
-            try:
-                alias = ProjectAlias.objects.get(alias=k, worker=worker)
-                db_projects[k] = alias.project
-            except ProjectAlias.DoesNotExist:
-                missing_projects.add(k)
-
-    errors = []
-    if len(missing_projects) == 0:
-        for pname, assessments in projects.items():
-            project = db_projects[pname]
-            for assessment in assessments:
-                year = assessment["year"]
-                month = assessment["month"]
-                try:
-                    obj, created = WorkAssessment.objects.get_or_create(
-                        worker=worker,
-                        project=project,
-                        year=year,
-                        month=month,
-                        defaults={"assessment": assessment["worked_time"]},
-                    )
-                    if not created:
-                        obj.assessment += assessment["worked_time"]
-                        obj.save()
-                except OutOfBoundsException as ex:
-                    errors.append(f"{project.name} ({year}-{month:02}): {ex}")
+    if progress:
+        progress(50)
+    target, missing_projects = worker_assessments(worker, projects)
+    if missing_projects:
+        add_missing_aliases(worker, missing_projects)
+        return missing_projects, []
+
+    with deferred_refresh(), transaction.atomic():
+        apply_worker_assessments(worker, target)
+
+    return missing_projects, []
+
+
+# Assessments of each project and month, and the names that are neither a
+# project nor an alias of the worker; names and aliases of the same project add up
+def worker_assessments(worker, projects):
+    db_projects = project_names_map(worker, projects.keys())
+    target = {}
+    for pname, assessments in projects.items():
+        if pname not in db_projects:
+            continue
+        for assessment in assessments:
+            key = db_projects[pname], assessment["year"], assessment["month"]
+            target[key] = (
+                target.get(key, datetime.timedelta()) + assessment["worked_time"]
+            )
+
+    return target, set(projects) - set(db_projects)
+
+
+def add_missing_aliases(worker, missing_projects):
+    MissingProjectAlias.objects.bulk_create(
+        [MissingProjectAlias(worker=worker, alias=p) for p in missing_projects],
+        ignore_conflicts=True,
+    )
+
+
+# project pk of each name, by project name or else by alias of the worker
+def project_names_map(worker, names):
+    names = set(names)
+    db_projects = dict(
+        ProjectAlias.objects.filter(worker=worker, alias__in=names).values_list(
+            "alias", "project_id"
+        )
+    )
+    db_projects.update(Project.objects.filter(name__in=names).values_list("name", "pk"))
+    return db_projects
+
+
+# Writes only the assessments that differ from the target ones, from first_ym
+# on if given; bulk queries send no signals, so the rollup months touched are
+# refreshed here
+def apply_worker_assessments(worker, target, first_ym=None):
+    assessments = WorkAssessment.objects.select_for_update().filter(worker=worker)
+    if first_ym is not None:
+        assessments = assessments.filter(ym__gte=first_ym)
+    existing = {(a.project_id, a.year, a.month): a for a in assessments}
+
+    created, updated = [], []
+    for (project_id, year, month), worked_time in target.items():
+        assessment = existing.get((project_id, year, month))
+        if assessment is None:
+            created.append(
+                WorkAssessment(
+                    worker=worker,
+                    project_id=project_id,
+                    year=year,
+                    month=month,
+                    assessment=worked_time,
+                )
+            )
+        elif assessment.assessment != worked_time:
+            assessment.assessment = worked_time
+            updated.append(assessment)
+    deleted = [a for key, a in existing.items() if key not in target]
+
+    WorkAssessment.objects.bulk_create(created)
+    WorkAssessment.objects.bulk_update(updated, ["assessment"])
+    WorkAssessment.objects.filter(pk__in=[a.pk for a in deleted]).delete()
+
+    for a in created + updated + deleted:
+        schedule_refresh(a.project_id, [month_ordinal(a.year, a.month)])
+
+
+# Sync API
+#
+# The APP pushes the checks added since the cursor the server acknowledged last,
+# either as JSON:
+#   {"cursor": 40, "checks": [{"id": 41, "timestamp": "2026-10-18T09:00:00.000",
+#                              "check_type": "Projecte", "multiplier": 100}, ...]}
+# or as NDJSON, with {"cursor": 40} on the first line and a check on each of the
+# following ones. Stops have no check_type.
+def parse_checks_batch(request):
+    if request.content_type == "application/x-ndjson":
+        lines = [json.loads(line) for line in request.body.splitlines() if line]
+        batch = lines[0] | {"checks": lines[1:]}
     else:
-        for p in missing_projects:
-            MissingProjectAlias.objects.get_or_create(worker=worker, alias=p)
+        batch = json.loads(request.body)
+
+    checks = []
+    for check in batch["checks"]:
+        check_type = check.get("check_type")
+        timestamp = datetime.datetime.fromisoformat(check["timestamp"])
+        checks.append(
+            {
+                "id": int(check["id"]),
+                "timestamp": timestamp.replace(tzinfo=datetime.timezone.utc),
+                "check_type": None if check_type is None else str(check_type).strip(),
+                "multiplier": int(check.get("multiplier", 100)),
+            }
+        )
+
+    return int(batch["cursor"]), checks
+
+
+# Stores the checks after the cursor of the worker and recomputes the months
+# they change. Returns the new cursor and the missing project names; nothing is
+# stored if some are missing, so the APP pushes the same checks again once the
+# aliases are set. A cursor ahead of the one of the worker gets the latter back,
+# so that the APP pushes the checks after it.
+def sync_worker_checks(worker, cursor, checks):
+    with deferred_refresh(), transaction.atomic():
+        cursor, missing_projects = sync_worker_checks_aux(worker, cursor, checks)
+        if missing_projects:
+            transaction.set_rollback(True)
+
+    if missing_projects:
+        add_missing_aliases(worker, missing_projects)
+    return cursor, missing_projects
+
+
+def sync_worker_checks_aux(worker, cursor, checks):
+    worker = Worker.objects.select_for_update().get(pk=worker.pk)
+    new_checks = [
+        WorkerCheck(
+            worker=worker,
+            app_id=check["id"],
+            timestamp=check["timestamp"],
+            check_type=check["check_type"],
+            multiplier=check["multiplier"],
+        )
+        for check in checks
+        if check["id"] > worker.app_cursor
+    ]
+    if cursor > worker.app_cursor or not new_checks:
+        return worker.app_cursor, set()
+
+    # the intervals after the last stop before the new checks were still running
+    worker_checks = WorkerCheck.objects.filter(worker=worker)
+    first = min(check.timestamp for check in new_checks)
+    last_stop = (
+        worker_checks.filter(check_type=None, timestamp__lt=first)
+        .order_by("timestamp")
+        .values_list("timestamp", flat=True)
+        .last()
+    )
+    WorkerCheck.objects.bulk_create(new_checks)
+    if last_stop is None:
+        last_stop = worker_checks.aggregate(first=Min("timestamp"))["first"]
+    first_ym = month_ordinal(last_stop.year, last_stop.month)
+
+    projects = WorkerChecks(worker, first_ym).get_projects_worked_time()
+    target, missing_projects = worker_assessments(worker, projects)
+    if missing_projects:
+        return worker.app_cursor, missing_projects
 
-    return missing_projects, errors
+    apply_worker_assessments(worker, target, first_ym)
+    worker.app_cursor = max(check.app_id for check in new_checks)
+    Worker.objects.filter(pk=worker.pk).update(app_cursor=worker.app_cursor)
+    return worker.app_cursor, missing_projects
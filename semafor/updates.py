@@ -0,0 +1,204 @@
+import time
+import asyncio
+import threading
+import traceback
+
+import redis.asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from channels.layers import get_channel_layer
+
+from semafor.presence import live_variants
+from semafor.feed import append
+from semafor.feed import seq_marker
+
+
+# Sends websocket updates from its own event loop, running in a background
+# thread. Updates are keyed by subscription group: scheduling a group that is
+# already pending is merged into the pending update, which is rendered once its
+# debounce window has elapsed, so a burst of edits renders each affected group
+# at most once per window. Each group is scheduled with the months that changed
+# in it, or None for all of them, and rendered once for each of its variants
+# with subscribers, which may skip the render if they do not show those months.
+# Renders use the ORM, so they run in a fixed pool of threads; the groups due at
+# the same time are rendered concurrently and their messages appended to the
+# feed of each group and sent together. The counters tell apart the groups not
+# rendered for lack of subscribers (unwatched) from the renders of variants not
+# showing the changed months (skipped); every stats_interval seconds, if they
+# changed, they are printed.
+class UpdateDispatcher:
+    def __init__(self, render, event_type, workers=2, debounce=0.3, stats_interval=0):
+        self.render = render
+        self.event_type = event_type
+        self.debounce = debounce
+        self.stats_interval = stats_interval
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.redis = redis.asyncio.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            decode_responses=True,
+        )
+        self.lock = threading.Lock()
+        self.loop = None
+        self.timer = None
+        self.pending = {}
+        self.running = set()
+        self.counters = {
+            "scheduled": 0,
+            "coalesced": 0,
+            "unwatched": 0,
+            "skipped": 0,
+            "rendered": 0,
+            "failed": 0,
+            "render_seconds": 0.0,
+            "max_queue_depth": 0,
+        }
+
+    # groups maps each group to its changed months, or is an iterable of groups
+    # that changed in all of them; from sync code, returns without waiting for
+    # the update to be queued
+    def schedule(self, groups):
+        groups = self.changes(groups)
+        if groups:
+            asyncio.run_coroutine_threadsafe(self.add(groups), self.start())
+
+    # from async code, in any event loop
+    async def notify(self, groups):
+        groups = self.changes(groups)
+        loop = self.start()
+        if groups and asyncio.get_running_loop() is loop:
+            await self.add(groups)
+        elif groups:
+            await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(self.add(groups), loop)
+            )
+
+    def changes(self, groups):
+        if isinstance(groups, dict):
+            return dict(groups)
+        return dict.fromkeys(groups)
+
+    def stats(self):
+        return self.counters | {
+            "queue_depth": len(self.pending),
+            "running": len(self.running),
+        }
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+                if self.stats_interval:
+                    asyncio.run_coroutine_threadsafe(self.print_stats(), self.loop)
+        return self.loop
+
+    async def print_stats(self):
+        last = None
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            stats = self.stats()
+            if stats != last:
+                counters = ", ".join(
+                    f"{name} {round(value, 2)}" for name, value in stats.items()
+                )
+                print(f"{self.event_type}: {counters}", flush=True)
+                last = stats
+
+    async def add(self, groups):
+        due = self.loop.time() + self.debounce
+        for group, months in groups.items():
+            self.counters["scheduled"] += 1
+            if group in self.pending:
+                self.counters["coalesced"] += 1
+                group_due, pending = self.pending[group]
+                if months is not None and pending is not None:
+                    months = set(months) | pending
+                else:
+                    months = None
+                self.pending[group] = group_due, months
+            else:
+                self.pending[group] = due, months and set(months)
+        self.counters["max_queue_depth"] = max(
+            self.counters["max_queue_depth"], len(self.pending)
+        )
+        self.wake()
+
+    # a group is never rendered twice at the same time, so that an older
+    # render can not be sent after a newer one
+    def wake(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        waiting = [d for g, (d, _) in self.pending.items() if g not in self.running]
+        if waiting:
+            self.timer = self.loop.call_at(
+                min(waiting), lambda: self.loop.create_task(self.flush())
+            )
+
+    async def flush(self):
+        now = self.loop.time()
+        groups = {
+            g: self.pending.pop(g)[1]
+            for g, (due, _) in list(self.pending.items())
+            if due <= now and g not in self.running
+        }
+        self.running.update(groups)
+        self.wake()
+
+        try:
+            live = await self.live(list(groups))
+            self.counters["unwatched"] += len(groups) - len({g for g, _ in live})
+            messages = await asyncio.gather(
+                *(self.update(variant, groups[group]) for group, variant in live)
+            )
+            await asyncio.gather(
+                *(
+                    self.publish(variant, content)
+                    for (_, variant), content in zip(live, messages)
+                    if content
+                )
+            )
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.running.difference_update(groups)
+            self.wake()
+
+    async def live(self, groups):
+        if not groups:
+            return []
+        return await live_variants(self.redis, groups)
+
+    async def update(self, group, months):
+        start = time.perf_counter()
+        try:
+            content = await self.loop.run_in_executor(
+                self.executor, self.render_in_thread, group, months
+            )
+            if content is None:
+                self.counters["skipped"] += 1
+            else:
+                self.counters["rendered"] += 1
+            return content
+        except Exception:
+            traceback.print_exc()
+            self.counters["failed"] += 1
+        finally:
+            self.counters["render_seconds"] += time.perf_counter() - start
+
+    async def publish(self, group, content):
+        seq = await append(self.redis, group, content)
+        await get_channel_layer().group_send(
+            group, {"type": self.event_type, "content": content + seq_marker(seq)}
+        )
+
+    def render_in_thread(self, group, months):
+        close_old_connections()
+        try:
+            return self.render(group, months)
+        finally:
+            close_old_connections()
@@ -54,6 +54,11 @@ urlpatterns = [
         views.UpdateWorkerAssessmentsView.as_view(),
         name="update_worker_assessment",
     ),
+    path(
+        "jobs/<uuid:pk>/",
+        views.ImportJobView.as_view(),
+        name="import_job",
+    ),
     path(
         "assessment/project/<uuid:pk>/",
         views.ProjectAssessmentView.as_view(),
@@ -65,6 +70,11 @@ urlpatterns = [
         name="download_project_assessment_csv",
     ),
     path("liquidity", views.LiquidityView.as_view(), name="liquidity"),
+    path(
+        "liquidity/transactions/",
+        views.LiquidityTransactionsView.as_view(),
+        name="liquidity_transactions",
+    ),
     path(
         "liquidity/upload/",
         views.UploadLiquidityView.as_view(),
@@ -75,6 +85,11 @@ urlpatterns = [
         views.DownloadLiquidityCSVView.as_view(),
         name="download_liquidity_csv",
     ),
+    path(
+        "liquidity/transactions/assign/",
+        views.AssignTransactionsView.as_view(),
+        name="assign_transactions",
+    ),
     path(
         "liquidity/transaction/<int:pk>/projects/update/",
         views.UpdateTransactionProjectsView.as_view(),
@@ -85,6 +100,26 @@ urlpatterns = [
         views.UpdateTransactionWorkersView.as_view(),
         name="update_transaction_workers",
     ),
+    path(
+        "liquidity/rules/",
+        views.AssignmentRulesView.as_view(),
+        name="assignment_rules",
+    ),
+    path(
+        "liquidity/rules/create/",
+        views.CreateAssignmentRuleView.as_view(),
+        name="create_assignment_rule",
+    ),
+    path(
+        "liquidity/rules/<int:pk>/delete/",
+        views.DeleteAssignmentRuleView.as_view(),
+        name="delete_assignment_rule",
+    ),
+    path(
+        "liquidity/rules/apply/",
+        views.AutoAssignTransactionsView.as_view(),
+        name="auto_assign_transactions",
+    ),
     # not done
     # path(
     #    "expected_liquidity",
@@ -1,9 +1,10 @@
 import io
+import json
 import redis
 import base64
-import threading
 
 import matplotlib
+import decimal
 import pandas as pd
 import datetime as dt
 
@@ -15,21 +16,30 @@ import matplotlib.pyplot as plt
 from django.urls import reverse
 from django.conf import settings
 from django.utils import timezone
+from django.db.models import OuterRef, Prefetch, Subquery, Sum, prefetch_related_objects
+from django.db.models import DecimalField, ExpressionWrapper, Q
+from django.db.models.functions import Coalesce
 from django.views.generic import UpdateView
 from django.template.loader import render_to_string
 from django.utils.translation import gettext_lazy as _
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-
 
 from semafor.models import Project
+from semafor.models import ProjectMonth
 from semafor.models import Worker
 from semafor.models import WorkerMonthDedication
 from semafor.models import WorkForecast
-from semafor.models import WorkAssessment
 from semafor.models import MissingProjectAlias
+from semafor.models import Transaction
 from semafor.models import months_range
+from semafor.cube import ForecastCube
+from semafor.cube import AssessmentCube
+from semafor.cube import filter_time_span
+from semafor.rollup import update_stale_project_months
+from semafor.updates import UpdateDispatcher
+from semafor.fragments import diff
+from semafor.feed import current_seq
+from semafor.search import search_transactions
 
 r = redis.Redis(
     host=settings.REDIS_HOST,
@@ -76,13 +86,6 @@ def yes_no(b):
     return _("No")
 
 
-def parse_int_safe(x):
-    try:
-        return int(x)
-    except (ValueError, TypeError):
-        return 0
-
-
 def format_month(ym):
     return f"{ym[1]:02}/{ym[0]}"
 
@@ -112,6 +115,7 @@ def add_time_span(
     min_start=None,
     extra_months=None,
     force_start=None,
+    force_end=None,
 ):
     dates_start = [x.date_start() for x in projects]
     dates_end = [x.date_end() for x in projects]
@@ -129,123 +133,122 @@ def add_time_span(
 
         if force_start:
             date_start = force_start
+        if force_end:
+            date_end = force_end
         context["time_span"] = list(months_range(date_start, date_end))
 
     return context
 
 
-def add_projects_forecast_context(context, worker=None, force_start=None):
-    projects = Project.objects.filter(archived=False).prefetch_related(
-        "workforecast_set__worker", "workassessment_set"
-    )
-    context["projects"] = projects
-    context["workers"] = Worker.objects.all()
+def add_forecast_time_span(context, projects, force_start=None, force_end=None):
     now = timezone.now()
-    add_time_span(
+    return add_time_span(
         context,
         projects,
         min_start=dt.date(now.year, now.month, 1),
         extra_months=6,
         force_start=force_start,
+        force_end=force_end,
     )
 
-    context = add_worked_forecast(context, projects, worker=worker)
 
-    workforecasts = WorkForecast.objects.all().prefetch_related("project", "worker")
+def add_projects_forecast_context(
+    context, worker=None, force_start=None, force_end=None
+):
+    projects = list(Project.objects.filter(archived=False).with_month_bounds())
+    context["workers"] = Worker.objects.all()
+    add_forecast_time_span(
+        context, projects, force_start=force_start, force_end=force_end
+    )
+    time_span = context.get("time_span", [])
+
+    if worker:
+        forecasts = filter_time_span(
+            WorkForecast.objects.filter(worker=worker), time_span
+        )
+        prefetch_related_objects(
+            projects,
+            Prefetch(
+                "workforecast_set", queryset=forecasts, to_attr="visible_forecasts"
+            ),
+        )
+    context["projects"] = projects
+
+    cube = ForecastCube(projects, context["workers"], time_span)
+    context = add_worked_forecast(context, cube, worker=worker)
+
     if worker:
-        project_forecasts = {}
-        for p in projects:
-            project_forecasts[p.uuid] = {}
-            for pa in (
-                x for x in workforecasts if x.project == p and x.worker == worker
-            ):
-                k = (pa.year, pa.month)
-                project_forecasts[p.uuid][k] = pa
-
-        context["project_forecasts"] = project_forecasts
-
-    return add_dedications(context, worker=worker)
-
-
-def add_worked_forecast(context, projects, worker=None):
-    confirmed_worked, total_worked = {}, {}
-    for p in projects:
-        totals, _ = p.work_forecasts(worker=worker)
-        for k, v in totals.items():
-            total_worked.setdefault(k, 0)
-            confirmed_worked.setdefault(k, 0)
-            total_worked[k] += v
-            if p.confirmed:
-                confirmed_worked[k] += v
+        context["project_forecasts"] = {
+            p.uuid: {(wf.year, wf.month): wf for wf in p.visible_forecasts}
+            for p in projects
+        }
 
+    return add_dedications(context, time_span, worker=worker)
+
+
+def add_worked_forecast(context, cube, worker=None):
     return context | {
-        "confirmed_worked_forecast": confirmed_worked,
-        "total_worked_forecast": total_worked,
+        "forecast_cube": cube,
+        "confirmed_worked_forecast": cube.totals(worker=worker, confirmed=True),
+        "total_worked_forecast": cube.totals(worker=worker),
     }
 
 
 def add_projects_assessment_context(context):
-    projects = Project.objects.all().prefetch_related(
-        "workassessment_set",
-        "workforecast_set",
-        "transactions",
+    update_stale_project_months()
+    last_month = ProjectMonth.objects.filter(project=OuterRef("pk")).order_by(
+        "-year", "-month"
     )
-    projects = sorted(projects, key=lambda p: -p.amount_span())
-    context["projects"] = projects
+    amount = DecimalField(max_digits=14, decimal_places=2)
+    context["projects"] = Project.objects.annotate(
+        total_amount_span=ExpressionWrapper(
+            Coalesce(Sum("months__income"), decimal.Decimal(0))
+            + Coalesce(Sum("months__other_expenses"), decimal.Decimal(0))
+            + Coalesce(Sum("months__work_expenses"), decimal.Decimal(0)),
+            output_field=amount,
+        ),
+        total_balance=Coalesce(
+            Subquery(last_month.values("balance")[:1]),
+            decimal.Decimal(0),
+            output_field=amount,
+        ),
+    ).order_by("-total_amount_span", "name")
     context["workers"] = Worker.objects.all()
     return context
 
 
 def add_worker_projects_assessment_context(context, worker):
-    projects = Project.objects.all().prefetch_related(
-        "workassessment_set__worker",
-        "workforecast_set",
-    )
+    projects = list(Project.objects.with_month_bounds())
     context["workers"] = Worker.objects.all()
     context["projects"] = projects
     context = add_time_span(context, projects)
-    context = add_worked_assessment(context, projects, worker=worker)
-
-    workassessments = WorkAssessment.objects.all().prefetch_related("project", "worker")
-    project_assessments = {}
-    for p in projects:
-        project_assessments[p.uuid] = {}
-        for pa in (x for x in workassessments if x.project == p and x.worker == worker):
-            k = (pa.year, pa.month)
-            project_assessments[p.uuid][k] = pa
-
-    context["project_assessments"] = project_assessments
+    cube = AssessmentCube(projects, context["workers"], context.get("time_span", []))
+    context = add_worked_assessment(context, cube, worker=worker)
     context["missing_projects"] = MissingProjectAlias.objects.filter(worker=worker)
 
     return context
 
 
-def add_worked_assessment(context, projects, worker=None):
-    total_worked = {}
-    for p in projects:
-        totals, _ = p.work_assessments(worker=worker)
-        for k, v in totals.items():
-            total_worked.setdefault(k, dt.timedelta(0))
-            total_worked[k] += v
-
-    return context | {"total_worked_assessment": total_worked}
+def add_worked_assessment(context, cube, worker=None):
+    return context | {
+        "assessment_cube": cube,
+        "total_worked_assessment": cube.totals(worker=worker),
+    }
 
 
-def add_dedications(context, worker=None):
+def add_dedications(context, time_span, worker=None):
     total_dedication = {}
     worker_dedications = {}
     if worker:
-        dedications = WorkerMonthDedication.objects.filter(
-            worker=worker
-        ).prefetch_related("worker")
+        dedications = WorkerMonthDedication.objects.filter(worker=worker)
     else:
-        dedications = WorkerMonthDedication.objects.all().prefetch_related("worker")
-    for wd in dedications:
+        dedications = WorkerMonthDedication.objects.all()
+    for wd in filter_time_span(dedications, time_span):
         k = (wd.year, wd.month)
         total_dedication.setdefault(k, 0)
         total_dedication[k] += wd.dedication
-        worker_dedications.setdefault(wd.worker.uuid, {})
-        worker_dedications[wd.worker.uuid][k] = wd
+        worker_dedications.setdefault(wd.worker_id, {})
+        worker_dedications[wd.worker_id][k] = wd
 
     return context | {
         "total_dedication": total_dedication,
@@ -253,12 +256,15 @@ def add_dedications(context, worker=None):
     }
 
 
-def add_workers_forecast_context(project):
+def add_workers_forecast_context(project, force_start=None, force_end=None):
     context = {"object": project}
-    context["time_span"] = project.forecast_months_range()
+    context["time_span"] = project.forecast_months_range(
+        force_start=force_start, force_end=force_end
+    )
     context["workers"] = Worker.objects.all()
-    context = add_worked_forecast(context, [project])
-    return add_dedications(context)
+    cube = ForecastCube([project], context["workers"], context["time_span"])
+    context = add_worked_forecast(context, cube)
+    return add_dedications(context, context["time_span"])
 
 
 def add_workers_assessment_context(project):
@@ -266,11 +272,13 @@ def add_workers_assessment_context(project):
     assessed_time_span = project.assessment_months_range(end=previous_month(now))
     forecasted_time_span = project.forecast_months_range(start=now, force_start=now)
     time_span = assessed_time_span + forecasted_time_span
-    workers = Worker.objects.all().prefetch_related("workassessment_set__project")
+    workers = Worker.objects.all()
 
-    context = add_worked_assessment({}, [project])
-    context = add_worked_forecast(context, [project])
-    context = add_dedications(context)
+    context = add_worked_assessment({}, AssessmentCube([project], workers, time_span))
+    context = add_worked_forecast(
+        context, ForecastCube([project], workers, forecasted_time_span)
+    )
+    context = add_dedications(context, forecasted_time_span)
     return context | {
         "object": project,
         "assessed_time_span": assessed_time_span,
@@ -281,6 +289,7 @@ def add_workers_assessment_context(project):
 
 
 def add_economic_balance_context(context, project):
+    update_stale_project_months()
     months, balance_map, income, expenses, work_expenses, other_expenses = (
         project.economic_balance()
     )
@@ -328,69 +337,187 @@ def add_total_dedication_context(context, obj):
     return context
 
 
+def parse_date(s):
+    try:
+        return dt.date.fromisoformat(s)
+    except (TypeError, ValueError):
+        return None
+
+
+# The transactions are paged newest first by (date, id), which the index of
+# Transaction covers: each page continues after the last row of the previous
+# one, given as the before=<date>_<id> parameter, so every page costs the same
+# whatever the number of transactions stored. The filters are also parameters:
+# q, words searched in the concept, start and end dates, assigned (YES, both a
+# project and a worker, or NO) and sign (INCOME or EXPENSE).
+def filter_transactions(params):
+    qs = Transaction.objects.all()
+    start = parse_date(params.get("start"))
+    if start:
+        qs = qs.filter(date__gte=start)
+    end = parse_date(params.get("end"))
+    if end:
+        qs = qs.filter(date__lte=end)
+
+    if params.get("assigned") == "YES":
+        qs = qs.with_assignment().filter(has_project=True, has_worker=True)
+    elif params.get("assigned") == "NO":
+        qs = qs.with_assignment().filter(Q(has_project=False) | Q(has_worker=False))
+
+    qs = search_transactions(qs, params.get("q"))
+
+    if params.get("sign") == "INCOME":
+        qs = qs.filter(amount__gt=0)
+    elif params.get("sign") == "EXPENSE":
+        qs = qs.filter(amount__lt=0)
+    return qs
+
+
+def add_transactions_page_context(context, params):
+    qs = filter_transactions(params).order_by("-date", "-id")
+    before_date, _, before_id = params.get("before", "").partition("_")
+    before_date = parse_date(before_date)
+    if before_date and before_id.isdigit():
+        qs = qs.filter(
+            Q(date__lt=before_date) | Q(date=before_date, id__lt=int(before_id))
+        )
+
+    size = settings.LIQUIDITY_PAGE_SIZE
+    transactions = list(qs.prefetch_related("projects", "workers")[: size + 1])
+    context["transactions"] = transactions[:size]
+    context["next_url"] = None
+    if len(transactions) > size:
+        last = transactions[size - 1]
+        next_params = params.copy()
+        next_params["before"] = f"{last.date.isoformat()}_{last.id}"
+        context["next_url"] = (
+            f"{reverse('liquidity_transactions')}?{next_params.urlencode()}"
+        )
+    return context
+
+
 # Websocket updates utils
 
 
-# TODO better performance for rendering those templates; django debug toolbar does not know how many
-# db requests are made
-def update_forecast_pages(worker=None, project=None):
-    def f(worker, project):
-        channel_layer = get_channel_layer()
+def parse_month(s):
+    try:
+        return dt.datetime.strptime(s, "%Y-%m").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def format_window_month(date):
+    return f"{date:%Y-%m}" if date else ""
+
 
-        if worker:
-            workers = [worker]
-        else:
-            workers = Worker.objects.all()
+# Pages showing an explicit window of months subscribe to a variant of their
+# group, rendered for that window and shared by the pages showing the same one
+def window_group(group, start=None, end=None):
+    if not start and not end:
+        return group
+    return f"{group}.{format_window_month(start)}.{format_window_month(end)}"
 
-        if project:
-            projects = [project]
-        else:
-            projects = Project.objects.all()
 
-        subscription_groups = (
-            [f"forecast_worker_{worker.uuid}" for worker in workers]
-            + [f"forecast_project_{project.uuid}" for project in projects]
-            + ["forecast_all"]
+def parse_window_group(group):
+    if "." not in group:
+        return group, None, None
+    group, start, end = group.split(".")
+    return group, parse_month(start), parse_month(end)
+
+
+def add_feed_context(context, group, start=None, end=None):
+    context["feed_seq"] = current_seq(r, window_group(group, start, end))
+    context["window_start"] = format_window_month(start)
+    context["window_end"] = format_window_month(end)
+    return context
+
+
+def forecast_group_context(group):
+    group, start, end = parse_window_group(group)
+    if group == "forecast_all":
+        return "fragments/forecast_all.html", add_projects_forecast_context(
+            {}, force_start=start, force_end=end
+        )
+    elif group.startswith("forecast_worker_"):
+        worker = Worker.objects.get(uuid=group.removeprefix("forecast_worker_"))
+        return "fragments/worker_forecast.html", add_projects_forecast_context(
+            {"object": worker}, worker=worker, force_start=start, force_end=end
+        )
+    else:
+        project = Project.objects.with_month_bounds().get(
+            uuid=group.removeprefix("forecast_project_")
         )
-        counts = [parse_int_safe(x) for x in r.mget(subscription_groups)]
-        group_counts = dict(zip(subscription_groups, counts))
-
-        for worker in workers:
-            group = f"forecast_worker_{worker.uuid}"
-            if group_counts[group] > 0:
-                content = render_to_string(
-                    "fragments/worker_forecast.html",
-                    add_projects_forecast_context({"object": worker}, worker=worker),
-                )
-                async_to_sync(channel_layer.group_send)(
-                    group,
-                    {"type": "forecast_update", "content": content},
-                )
-
-        for project in projects:
-            group = f"forecast_project_{project.uuid}"
-            if group_counts[group] > 0:
-                content = render_to_string(
-                    "fragments/project_forecast.html",
-                    add_workers_forecast_context(project),
-                )
-                async_to_sync(channel_layer.group_send)(
-                    group,
-                    {"type": "forecast_update", "content": content},
-                )
-
-        if group_counts["forecast_all"] > 0:
-            content = render_to_string(
-                "fragments/forecast_all.html",
-                add_projects_forecast_context({}),
-            )
-            async_to_sync(channel_layer.group_send)(
-                "forecast_all",
-                {"type": "forecast_update", "content": content},
-            )
-
-    # TODO do it with something cheaper than a thread? async?
-    threading.Thread(target=f, args=[worker, project]).start()
+        return "fragments/project_forecast.html", add_workers_forecast_context(
+            project, force_start=start, force_end=end
+        )
+
+
+def render_forecast_fragment(group):
+    return render_to_string(*forecast_group_context(group))
+
+
+# Renders the changes of the group, if the changed months are shown in it
+def render_forecast_group(group, months=None):
+    template, context = forecast_group_context(group)
+    if months is not None and not months & set(context.get("time_span", [])):
+        return None
+
+    content = render_to_string(template, context)
+    key = f"forecast_snapshot_{group}"
+    previous = r.get(key)
+    snapshot, content = diff(previous and json.loads(previous), content)
+    r.set(key, json.dumps(snapshot), ex=settings.FEED_TTL)
+    return content
+
+
+forecast_updates = UpdateDispatcher(
+    render_forecast_group,
+    "forecast_update",
+    workers=settings.FORECAST_UPDATE_WORKERS,
+    debounce=settings.FORECAST_UPDATE_DEBOUNCE,
+    stats_interval=settings.FORECAST_UPDATE_STATS_INTERVAL,
+)
+
+
+# Invalidation map: the subscription groups whose pages show a changed entity,
+# with the months where it is shown (None for all of them). The total and
+# worker pages list every project that is not archived; the project pages list
+# every worker. Each page variant is only rendered if it shows those months.
+
+
+def work_forecast_groups(forecast):
+    months = {(forecast.year, forecast.month)}
+    groups = {f"forecast_project_{forecast.project_id}": months}
+    if not forecast.project.archived:
+        groups["forecast_all"] = months
+        groups[f"forecast_worker_{forecast.worker_id}"] = months
+    return groups
+
+
+def dedication_groups(dedication):
+    months = {(dedication.year, dedication.month)}
+    groups = {
+        "forecast_all": months,
+        f"forecast_worker_{dedication.worker_id}": months,
+    }
+    for project_id in Project.objects.values_list("pk", flat=True):
+        groups[f"forecast_project_{project_id}"] = months
+    return groups
+
+
+# Confirming a project moves its row between the confirmed and unconfirmed
+# tables of every page listing it and changes the confirmed totals of all months
+def project_groups(project):
+    groups = {f"forecast_project_{project.uuid}": None}
+    if not project.archived:
+        groups["forecast_all"] = None
+        for worker_id in Worker.objects.values_list("pk", flat=True):
+            groups[f"forecast_worker_{worker_id}"] = None
+    return groups
+
+
+def update_forecast_pages(groups):
+    forecast_updates.schedule(groups)
 
 
 class UpdateSingleFieldView(UpdateView):
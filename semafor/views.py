@@ -1,13 +1,12 @@
 import csv
 import copy
 import decimal
-import tempfile
 import datetime as dt
 
 
 from django.urls import reverse, reverse_lazy
-from django.http import HttpResponse, JsonResponse
-from django.db.utils import IntegrityError
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect, render, get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
@@ -31,6 +30,8 @@ from semafor.models import WorkerMonthDedication
 from semafor.models import WorkForecast
 from semafor.models import Transaction
 from semafor.models import ExpectedTransaction
+from semafor.models import ImportJob
+from semafor.models import AssignmentRule
 from semafor.models import months_range
 
 from semafor.utils import (
@@ -43,12 +44,22 @@ from semafor.utils import (
     add_workers_assessment_context,
     add_economic_balance_context,
     add_total_dedication_context,
+    add_transactions_page_context,
+    add_feed_context,
+    parse_month,
     update_forecast_pages,
+    work_forecast_groups,
+    dedication_groups,
+    project_groups,
 )
 
 from semafor.tenders import extract_tenders
-from semafor.time_control import update_worker_assessments
-from semafor.banking import RuralVia
+from semafor.time_control import parse_checks_batch
+from semafor.time_control import sync_worker_checks
+from semafor.jobs import enqueue_import
+from semafor.jobs import job_status
+from semafor.assignment import assign_transactions
+from semafor.assignment import auto_assign_transactions
 
 
 # Permission mixins
@@ -82,6 +93,13 @@ class CSVView(View):
         return f"{n:.2f}".replace(".", ",")
 
 
+class ForecastWindowMixin:
+    def dispatch(self, request, *args, **kwargs):
+        self.start = parse_month(request.GET.get("start"))
+        self.end = parse_month(request.GET.get("end"))
+        return super().dispatch(request, *args, **kwargs)
+
+
 class IgnoreResponseMixin:
     def get_success_url(self):
         return reverse("ignore")
@@ -95,49 +113,44 @@ def ignore(request):
     return HttpResponse("")
 
 
-class ForecastView(StaffRequiredMixin, ListView):
+class ForecastView(StaffRequiredMixin, ForecastWindowMixin, ListView):
     model = Project
     template_name = "semafor/forecast_all.html"
 
-    def dispatch(self, request, *args, **kwargs):
-        try:
-            self.start = dt.datetime.strptime(request.GET.get("start"), "%Y-%m").date()
-        except Exception:
-            self.start = None
-        return super().dispatch(request, *args, **kwargs)
-
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        return add_projects_forecast_context(context, force_start=self.start)
+        context = add_feed_context(context, "forecast_all", self.start, self.end)
+        return add_projects_forecast_context(
+            context, force_start=self.start, force_end=self.end
+        )
 
 
-class WorkerForecastView(StaffRequiredMixin, DetailView):
+class WorkerForecastView(StaffRequiredMixin, ForecastWindowMixin, DetailView):
     model = Worker
     template_name = "semafor/worker_forecast.html"
 
-    def dispatch(self, request, *args, **kwargs):
-        try:
-            self.start = dt.datetime.strptime(request.GET.get("start"), "%Y-%m").date()
-        except Exception:
-            self.start = None
-        return super().dispatch(request, *args, **kwargs)
-
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        group = f"forecast_worker_{self.object.uuid}"
+        context = add_feed_context(context, group, self.start, self.end)
         return add_projects_forecast_context(
-            context, worker=self.get_object(), force_start=self.start
+            context, worker=self.object, force_start=self.start, force_end=self.end
         )
 
 
-class ProjectForecastView(StaffRequiredMixin, DetailView):
+class ProjectForecastView(StaffRequiredMixin, ForecastWindowMixin, DetailView):
     model = Project
     template_name = "semafor/project_forecast.html"
 
     def get_queryset(self):
-        return super().get_queryset().prefetch_related("workforecast_set__worker")
+        return super().get_queryset().with_month_bounds()
 
     def get_context_data(self, **kwargs):
-        return add_workers_forecast_context(self.get_object())
+        group = f"forecast_project_{self.object.uuid}"
+        context = add_feed_context({}, group, self.start, self.end)
+        return context | add_workers_forecast_context(
+            self.object, force_start=self.start, force_end=self.end
+        )
 
 
 class WorkerDedicationView(StaffRequiredMixin, DetailView):
@@ -151,7 +164,7 @@ class CreateWorkerDedicationView(StaffRequiredMixin, CreateView):
 
     def post(self, *args, **kwargs):
         response = super().post(*args, **kwargs)
-        update_forecast_pages(worker=self.object.worker)
+        update_forecast_pages(dedication_groups(self.object))
         return response
 
 
@@ -162,8 +175,7 @@ class UpdateWorkerDedicationView(StaffRequiredMixin, UpdateView):
 
     def post(self, *args, **kwargs):
         response = super().post(*args, **kwargs)
-        d = self.get_object()
-        update_forecast_pages(worker=d.worker)
+        update_forecast_pages(dedication_groups(self.object))
         return response
 
 
@@ -190,7 +202,7 @@ class UpdateProjectConfirmedView(StaffRequiredMixin, IgnoreResponseMixin, Update
 
     def post(self, *args, **kwargs):
         response = super().post(*args, **kwargs)
-        update_forecast_pages()
+        update_forecast_pages(project_groups(self.object))
         return response
 
 
@@ -201,8 +213,7 @@ class UpdateWorkForecastView(StaffRequiredMixin, UpdateView):
 
     def post(self, *args, **kwargs):
         response = super().post(*args, **kwargs)
-        a = self.get_object()
-        update_forecast_pages(worker=a.worker, project=a.project)
+        update_forecast_pages(work_forecast_groups(self.object))
         return response
 
     def get_context_data(self, **kwargs):
@@ -233,19 +244,60 @@ class ProjectAssessmentView(StaffRequiredMixin, DetailView):
     template_name = "semafor/project_assessment.html"
 
     def get_queryset(self):
-        return super().get_queryset().prefetch_related("workassessment_set")
+        return super().get_queryset().with_month_bounds()
 
     def get_context_data(self, **kwargs):
-        context = add_workers_assessment_context(self.get_object())
-        return add_economic_balance_context(context, self.get_object())
+        context = add_workers_assessment_context(self.object)
+        return add_economic_balance_context(context, self.object)
 
 
-class LiquidityView(StaffRequiredMixin, ListView):
-    model = Transaction
+class LiquidityView(StaffRequiredMixin, TemplateView):
     template_name = "semafor/liquidity.html"
 
-    def get_queryset(self):
-        return super().get_queryset().prefetch_related("projects", "workers")
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["projects"] = Project.objects.all()
+        context["workers"] = Worker.objects.all()
+        context["filters"] = self.request.GET
+        return add_transactions_page_context(context, self.request.GET)
+
+
+# Next page of the transactions, loaded when the last row is revealed
+class LiquidityTransactionsView(StaffRequiredMixin, TemplateView):
+    template_name = "fragments/transaction_rows.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        return add_transactions_page_context(context, self.request.GET)
+
+
+# Assigns the selected transactions to a project and/or a worker, and swaps out
+# of band the cells of the transactions
+class AssignTransactionsView(StaffRequiredMixin, View):
+    def post(self, request, *args, **kwargs):
+        try:
+            project = Project.objects.filter(
+                pk=request.POST.get("project") or None
+            ).first()
+            worker = Worker.objects.filter(
+                pk=request.POST.get("worker") or None
+            ).first()
+            ids = [int(pk) for pk in request.POST.getlist("transactions")]
+        except (ValidationError, ValueError):
+            return HttpResponseBadRequest()
+
+        transactions = Transaction.objects.filter(pk__in=ids).prefetch_related(
+            "projects", "workers"
+        )
+        if transactions and (project or worker):
+            assign_transactions(transactions, project, worker)
+            transactions = transactions.all()
+
+        return render(
+            request,
+            "fragments/assign_transactions.html",
+            {"transactions": transactions},
+        )
 
 
 class ExpectedLiquidityView(StaffRequiredMixin, ListView):
@@ -278,24 +330,11 @@ class UploadLiquidityView(StaffRequiredMixin, TemplateView):
 
     def post(self, request, *args, **kwargs):
         try:
-            with tempfile.NamedTemporaryFile(delete_on_close=False) as fp:
-                fp.write(request.FILES["transactions_file"].read())
-                fp.close()
-
-                for t in RuralVia(fp.name).get_transactions():
-                    try:
-                        t.save()
-                    except IntegrityError:
-                        Transaction.objects.get(id=t.id).update(
-                            date=t.date,
-                            concept=t.concept,
-                            amount=t.amount,
-                            balance=t.balance,
-                        )
-
-            return render(request, self.template_name, {"ok": True})
+            job = enqueue_import("LIQUIDITY", request.FILES["transactions_file"])
+            return render(request, "fragments/import_job.html", {"job": job})
         except Exception as ex:
             print("EXCEPTION:", ex)
+            self.extra_context = {"error": True}
 
         return super().get(request)
 
@@ -314,23 +353,43 @@ class UpdateWorkerAssessmentsView(StaffRequiredMixin, TemplateView):
 
     def post(self, request, *args, **kwargs):
         try:
-            missing_projects, errors = update_worker_assessments(request, self.worker)
-            if len(missing_projects) > 0 or len(errors) > 0:
-                self.extra_context = {
-                    "projects": Project.objects.all(),
-                    "missing_projects": missing_projects,
-                    "errors": errors,
-                }
-                return super().get(request)
-
-            self.extra_context = {"ok": True}
-            return super().get(request)
+            job = enqueue_import(
+                "WORKER_ASSESSMENTS", request.FILES["checks_file"], self.worker
+            )
+            return render(request, "fragments/import_job.html", {"job": job})
         except Exception as ex:
             print(f"Could not update worker assessments: {ex}")
             self.extra_context = {"error": True}
             return super().get(request)
 
 
+# Polled by the upload forms until the job finishes, then shows its result in
+# the template of the form
+class ImportJobView(StaffRequiredMixin, DetailView):
+    model = ImportJob
+
+    def get_template_names(self):
+        if not self.object.finished():
+            return ["fragments/import_job.html"]
+        elif self.object.kind == "LIQUIDITY":
+            return ["fragments/upload_liquidity.html"]
+        return ["fragments/update_worker_assessment.html"]
+
+    def get_context_data(self, **kwargs):
+        job = self.object
+        context = {"job": job}
+        if job.finished():
+            context["ok"] = job.ok()
+            context["error"] = job.status == "FAILED"
+            context["object"] = job.worker
+            if job.result.get("missing_projects"):
+                context["projects"] = Project.objects.all()
+                context["missing_projects"] = job.result["missing_projects"]
+            context["errors"] = job.result.get("errors")
+            context["counts"] = job.result if job.kind == "LIQUIDITY" else None
+        return context
+
+
 class UpdateTransactionProjectsView(StaffRequiredMixin, TemplateView):
     template_name = "fragments/update_transaction_projects.html"
 
@@ -343,10 +402,6 @@ class UpdateTransactionProjectsView(StaffRequiredMixin, TemplateView):
         context["transaction"] = self.transaction
         return context
 
-    def get(self, request, *args, **kwargs):
-        self.extra_context = {"projects": Project.objects.all()}
-        return super().get(request)
-
     def post(self, request, *args, **kwargs):
         project_id = request.POST.get("project")
         try:
@@ -374,10 +429,6 @@ class UpdateTransactionWorkersView(StaffRequiredMixin, TemplateView):
         context["transaction"] = self.transaction
         return context
 
-    def get(self, request, *args, **kwargs):
-        self.extra_context = {"workers": Worker.objects.all()}
-        return super().get(request)
-
     def post(self, request, *args, **kwargs):
         worker_id = request.POST.get("worker")
         try:
@@ -392,6 +443,52 @@ class UpdateTransactionWorkersView(StaffRequiredMixin, TemplateView):
         return super().get(request)
 
 
+class AssignmentRulesView(StaffRequiredMixin, ListView):
+    model = AssignmentRule
+    template_name = "semafor/assignment_rules.html"
+
+    def get_queryset(self):
+        return super().get_queryset().select_related("project", "worker")
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["projects"] = Project.objects.all()
+        context["workers"] = Worker.objects.all()
+        return context
+
+
+# Appends the new rule, or its errors, to the table of rules
+class CreateAssignmentRuleView(StaffRequiredMixin, CreateView):
+    model = AssignmentRule
+    fields = ["pattern", "regex", "project", "worker"]
+    template_name = "fragments/assignment_rule.html"
+
+    def form_valid(self, form):
+        self.object = form.save()
+        return render(self.request, self.template_name, {"rule": self.object})
+
+
+class DeleteAssignmentRuleView(StaffRequiredMixin, DeleteView):
+    model = AssignmentRule
+    success_url = reverse_lazy("ignore")
+
+
+# GET previews the assignments of the rules, POST makes them
+class AutoAssignTransactionsView(StaffRequiredMixin, TemplateView):
+    template_name = "fragments/auto_assign.html"
+
+    def get(self, request, *args, **kwargs):
+        self.extra_context = {"matches": auto_assign_transactions(dry_run=True)}
+        return super().get(request)
+
+    def post(self, request, *args, **kwargs):
+        self.extra_context = {
+            "matches": auto_assign_transactions(),
+            "assigned": True,
+        }
+        return super().get(request)
+
+
 class ListProjectAlias(StaffRequiredMixin, ListView):
     model = ProjectAlias
 
@@ -477,8 +574,8 @@ class DownloadForecastCSVView(StaffRequiredMixin, CSVView):
             "Projectes confirmats",
             *[format_month(ym) for ym in ctx["time_span"]],
         ]
-        for project in ctx["projects"].filter(confirmed=True):
-            totals, _ = project.work_forecasts(worker=self.get_worker())
+        for project in (p for p in ctx["projects"] if p.confirmed):
+            totals = ctx["forecast_cube"].totals(project, self.get_worker())
             yield [
                 project.name,
                 *[totals.get(ym) for ym in ctx["time_span"]],
@@ -510,7 +607,7 @@ class DownloadProjectForecastCSVView(StaffRequiredMixin, CSVView):
             *[format_month(ym) for ym in ctx["time_span"]],
         ]
         for worker in ctx["workers"]:
-            totals, _ = self.project.work_forecasts(worker=worker)
+            totals = ctx["forecast_cube"].totals(self.project, worker)
             yield [
                 worker.name,
                 *[totals.get(ym) for ym in ctx["time_span"]],
@@ -531,7 +628,7 @@ class DownloadWorkerAssessmentCSVView(StaffRequiredMixin, CSVView):
             *[format_month(ym) for ym in ctx["time_span"]],
         ]
         for project in ctx["projects"]:
-            totals, _ = project.work_assessments(worker=self.worker)
+            totals = ctx["assessment_cube"].totals(project, self.worker)
             yield [
                 project.name,
                 *[format_duration(totals.get(ym)) for ym in ctx["time_span"]],
@@ -552,7 +649,7 @@ class DownloadProjectAssessmentCSVView(StaffRequiredMixin, CSVView):
             *[format_month(ym) for ym in ctx["time_span"]],
         ]
         for worker in ctx["workers"]:
-            totals, _ = self.project.work_assessments(worker=worker)
+            totals = ctx["assessment_cube"].totals(self.project, worker)
             yield [
                 worker.name,
                 *[format_duration(totals.get(ym)) for ym in ctx["time_span"]],
@@ -576,15 +673,41 @@ def api_update_worker_assessment(request, token):
     worker = get_object_or_404(Worker, app_token=token)
 
     try:
-        missing_projects, errors = update_worker_assessments(request, worker)
-        if len(missing_projects) > 0 or len(errors) > 0:
+        job = enqueue_import("WORKER_ASSESSMENTS", request.FILES["checks_file"], worker)
+        res = {
+            "ok": True,
+            "job": job.uuid,
+            "status_url": reverse("api_import_job", args=[token, job.uuid]),
+        }
+        return JsonResponse(res, status=202)
+    except Exception as ex:
+        print(f"Could not update worker assessments from api: {ex}")
+        return JsonResponse({"error": True})
+
+
+def api_import_job(request, token, pk):
+    job = get_object_or_404(ImportJob, pk=pk, worker__app_token=token)
+    return JsonResponse(job_status(job))
+
+
+# Only the checks added since the last sync; the response has the cursor to
+# push the next checks from
+@csrf_exempt
+@require_POST
+def api_sync_worker_checks(request, token):
+    worker = get_object_or_404(Worker, app_token=token)
+
+    try:
+        cursor, checks = parse_checks_batch(request)
+        new_cursor, missing_projects = sync_worker_checks(worker, cursor, checks)
+        if len(missing_projects) > 0 or new_cursor < cursor:
             res = {
                 "ok": False,
+                "cursor": new_cursor,
                 "missing_projects": list(missing_projects),
-                "errors": list(errors),
             }
             return JsonResponse(res)
-        return JsonResponse({"ok": True})
+        return JsonResponse({"ok": True, "cursor": new_cursor})
     except Exception as ex:
-        print(f"Could not update worker assessments from api: {ex}")
+        print(f"Could not sync worker checks from api: {ex}")
         return JsonResponse({"error": True})